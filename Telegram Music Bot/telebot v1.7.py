@@ -1,41 +1,1458 @@
 import os
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler, ConversationHandler
+import re
+import math
+import asyncio
+import bisect
+import contextvars
+import functools
+import hashlib
+import heapq
+import hmac
+import itertools
+import io
+import json
+import logging
+import logging.handlers
+import pickle
+import queue
+import shutil
+import signal
+import sqlite3
+import sys
+import tempfile
+from collections import Counter, OrderedDict, defaultdict
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaAudio, InlineQueryResultCachedAudio
+from telegram.error import TelegramError, RetryAfter, NetworkError, Forbidden, BadRequest
+from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler, ConversationHandler, TypeHandler, ApplicationHandlerStop, BaseRateLimiter, InlineQueryHandler, BasePersistence, PersistenceInput
+from telegram.request import HTTPXRequest
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+import httpx
+
+try:
+    from aiohttp import web
+except ImportError:  # aiohttp is only needed in webhook mode
+    web = None
+try:
+    import mutagen
+    from mutagen.id3 import ID3, TCON, COMM, TXXX
+    from mutagen.mp4 import MP4Tags, MP4FreeForm
+except ImportError:  # mutagen is only needed in retag mode
+    mutagen = None
 
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_USER_ID = 27218759
 GROUP_CHAT_ID = -1001317756719
 
-# Load allowed users from a file or create the file if it doesn't exist
-def load_allowed_users():
+# BOT_MODE=webhook serves updates over HTTP instead of long polling getUpdates
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# WEBHOOK_REGISTER=0 leaves setWebhook to whoever deploys the bot
+WEBHOOK_REGISTER = os.getenv('WEBHOOK_REGISTER', '1') == '1'
+
+# Prometheus metrics are served on http://METRICS_LISTEN:METRICS_PORT/metrics (needs aiohttp); 0 turns them off
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9090'))
+
+# Point these at a local Bot API server (or a stand-in) instead of api.telegram.org
+BOT_API_URL = os.getenv('BOT_API_URL', 'https://api.telegram.org/bot')
+BOT_API_FILE_URL = os.getenv('BOT_API_FILE_URL', 'https://api.telegram.org/file/bot')
+
+# Log records are JSON lines on stdout. Records are rendered where they are logged and put on a
+# queue; a QueueListener thread writes them, so a slow stdout pipe never stalls the event loop.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+logger = logging.getLogger('telebot')
+
+# update_id, user_id, chat_id and handler of the update being processed, plus the upload it belongs
+# to, so one upload can be followed from the genre keyboard to the forward
+CORRELATION = contextvars.ContextVar('correlation', default={})
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            **CORRELATION.get(),
+            **getattr(record, 'fields', {}),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def setup_logging() -> logging.handlers.QueueListener:
+    log_queue = queue.SimpleQueue()
+    # Records are formatted by the code that logs them, while its correlation ids are still set
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(JsonFormatter())
+    stream_handler = logging.StreamHandler(sys.stdout)
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx logs every Bot API request at INFO
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    return listener
+
+DB_PATH = os.getenv('DB_PATH', 'telebot.db')
+LEGACY_USERS_FILE = 'allowed_users.txt'
+
+def open_database(path):
+    db = sqlite3.connect(path)
+    # WAL keeps readers unblocked and makes every commit an append instead of a rewrite
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+def add_column_if_missing(db, table, column, declaration):
+    columns = {row[1] for row in db.execute(f'PRAGMA table_info({table})')}
+    if column not in columns:
+        db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+
+class UserStore:
+    # Allowed users live in SQLite; `users` mirrors the table so auth checks never touch the disk
+    def __init__(self, db):
+        self.db = db
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS allowed_users ('
+                       'user_id INTEGER PRIMARY KEY, date_added TEXT NOT NULL)')
+        self.users = dict(db.execute('SELECT user_id, date_added FROM allowed_users'))
+
+    def add(self, user_id, date_added=None) -> bool:
+        if user_id in self.users:
+            return False
+        date_added = date_added or datetime.now().strftime('%Y-%m-%d')
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO allowed_users (user_id, date_added) VALUES (?, ?)',
+                            (user_id, date_added))
+        self.users[user_id] = date_added
+        return True
+
+    def add_many(self, user_ids, date_added=None) -> list:
+        # All new users go in with one transaction: either the whole import lands or none of it
+        new_ids = [user_id for user_id in user_ids if user_id not in self.users]
+        date_added = date_added or datetime.now().strftime('%Y-%m-%d')
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO allowed_users (user_id, date_added) VALUES (?, ?)',
+                                [(user_id, date_added) for user_id in new_ids])
+        self.users.update((user_id, date_added) for user_id in new_ids)
+        return new_ids
+
+    def remove(self, user_id) -> bool:
+        if user_id not in self.users:
+            return False
+        with self.db:
+            self.db.execute('DELETE FROM allowed_users WHERE user_id = ?', (user_id,))
+        del self.users[user_id]
+        return True
+
+    def migrate_from_text(self, path) -> int:
+        # One-time import of the old "<user_id> <date_added>" file; it is renamed so it never runs twice
+        if self.users or not os.path.exists(path):
+            return 0
+        rows = []
+        with open(path, 'r') as file:
+            for line in file:
+                parts = line.split()
+                if parts:
+                    rows.append((int(parts[0]), parts[1] if len(parts) > 1 else "Unknown"))
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO allowed_users (user_id, date_added) VALUES (?, ?)', rows)
+        self.users.update(rows)
+        os.replace(path, path + '.migrated')
+        return len(rows)
+
+DB = open_database(DB_PATH)
+USER_STORE = UserStore(DB)
+USER_STORE.migrate_from_text(LEGACY_USERS_FILE)
+if not USER_STORE.users:
+    USER_STORE.add(ADMIN_USER_ID)
+
+ALLOWED_USERS = USER_STORE.users
+
+STATS_FLUSH_INTERVAL = 30
+
+class StatsStore:
+    # Counters and broadcast history are mutated in memory only; flush() writes what changed in one transaction
+    def __init__(self, db):
+        self.db = db
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS user_interactions ('
+                       'user_id INTEGER PRIMARY KEY, count INTEGER NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS broadcast_history ('
+                       'id INTEGER PRIMARY KEY AUTOINCREMENT, sent_at TEXT NOT NULL, message TEXT NOT NULL)')
+        self.interactions = dict(db.execute('SELECT user_id, count FROM user_interactions'))
+        self.history = list(db.execute('SELECT sent_at, message FROM broadcast_history ORDER BY id'))
+        self.dirty_users = set()
+        self.flushed_history = len(self.history)
+
+    def count_interaction(self, user_id):
+        self.interactions[user_id] = self.interactions.get(user_id, 0) + 1
+        self.dirty_users.add(user_id)
+
+    def forget_user(self, user_id):
+        self.interactions.pop(user_id, None)
+        self.dirty_users.add(user_id)
+
+    def flush(self):
+        new_history = self.history[self.flushed_history:]
+        if not self.dirty_users and not new_history:
+            return
+        dirty_users, self.dirty_users = self.dirty_users, set()
+        updated = [(user_id, self.interactions[user_id]) for user_id in dirty_users if user_id in self.interactions]
+        removed = [(user_id,) for user_id in dirty_users if user_id not in self.interactions]
+        with self.db:
+            self.db.executemany('INSERT INTO user_interactions (user_id, count) VALUES (?, ?) '
+                                'ON CONFLICT(user_id) DO UPDATE SET count = excluded.count', updated)
+            self.db.executemany('DELETE FROM user_interactions WHERE user_id = ?', removed)
+            self.db.executemany('INSERT INTO broadcast_history (sent_at, message) VALUES (?, ?)', new_history)
+        self.flushed_history += len(new_history)
+
+STATS_STORE = StatsStore(DB)
+USER_INTERACTIONS = STATS_STORE.interactions
+for user_id in ALLOWED_USERS:
+    USER_INTERACTIONS.setdefault(user_id, 0)
+BROADCAST_HISTORY = STATS_STORE.history
+
+# How often the Application hands changed user_data and conversation states to the persistence
+PERSISTENCE_INTERVAL = 5
+
+class SQLitePersistence(BasePersistence):
+    # One row per user, chat and conversation key instead of one pickle for everything. PTB only
+    # passes the entries touched since the last run, and rows whose pickle did not change are skipped.
+    # Only user_data is kept: nothing in the bot uses chat_data or bot_data.
+    def __init__(self, db):
+        super().__init__(store_data=PersistenceInput(chat_data=False, bot_data=False, callback_data=False),
+                         update_interval=PERSISTENCE_INTERVAL)
+        self.db = db
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS persisted_data ('
+                       'kind TEXT NOT NULL, id INTEGER NOT NULL, data BLOB NOT NULL, '
+                       'PRIMARY KEY (kind, id)) WITHOUT ROWID')
+            db.execute('CREATE TABLE IF NOT EXISTS conversations ('
+                       'name TEXT NOT NULL, key TEXT NOT NULL, state BLOB NOT NULL, '
+                       'PRIMARY KEY (name, key)) WITHOUT ROWID')
+            # Left behind by versions that persisted chat_data and bot_data too
+            db.execute("DELETE FROM persisted_data WHERE kind IN ('chat', 'bot')")
+        self.written = {}
+
+    def load(self, kind) -> dict:
+        data = {}
+        for row_id, blob in self.db.execute('SELECT id, data FROM persisted_data WHERE kind = ?', (kind,)):
+            data[row_id] = pickle.loads(blob)
+            self.written[(kind, row_id)] = blob
+        return data
+
+    def store(self, kind, row_id, data):
+        if not data:
+            # Nothing worth a row; this also clears out users whose last pending upload was forwarded
+            if (kind, row_id) in self.written:
+                self.drop(kind, row_id)
+            return
+        blob = pickle.dumps(data)
+        if self.written.get((kind, row_id)) == blob:
+            return
+        with self.db:
+            self.db.execute('INSERT INTO persisted_data (kind, id, data) VALUES (?, ?, ?) '
+                            'ON CONFLICT(kind, id) DO UPDATE SET data = excluded.data', (kind, row_id, blob))
+        self.written[(kind, row_id)] = blob
+
+    def drop(self, kind, row_id):
+        with self.db:
+            self.db.execute('DELETE FROM persisted_data WHERE kind = ? AND id = ?', (kind, row_id))
+        self.written.pop((kind, row_id), None)
+
+    async def get_user_data(self) -> dict:
+        return self.load('user')
+
+    async def get_chat_data(self) -> dict:
+        return self.load('chat')
+
+    async def get_bot_data(self) -> dict:
+        return self.load('bot').get(0, {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name) -> dict:
+        return {tuple(json.loads(key)): pickle.loads(state)
+                for key, state in self.db.execute('SELECT key, state FROM conversations WHERE name = ?', (name,))}
+
+    async def update_conversation(self, name, key, new_state) -> None:
+        with self.db:
+            if new_state is None:
+                self.db.execute('DELETE FROM conversations WHERE name = ? AND key = ?', (name, json.dumps(key)))
+            else:
+                self.db.execute('INSERT INTO conversations (name, key, state) VALUES (?, ?, ?) '
+                                'ON CONFLICT(name, key) DO UPDATE SET state = excluded.state',
+                                (name, json.dumps(key), pickle.dumps(new_state)))
+
+    async def update_user_data(self, user_id, data) -> None:
+        self.store('user', user_id, data)
+
+    async def update_chat_data(self, chat_id, data) -> None:
+        self.store('chat', chat_id, data)
+
+    async def update_bot_data(self, data) -> None:
+        self.store('bot', 0, data)
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_user_data(self, user_id) -> None:
+        self.drop('user', user_id)
+
+    async def drop_chat_data(self, chat_id) -> None:
+        self.drop('chat', chat_id)
+
+    async def refresh_user_data(self, user_id, user_data) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def flush(self) -> None:
+        # Every update is committed as it comes in, nothing is left to write on shutdown
+        pass
+
+FORWARD_WORKERS = int(os.getenv('FORWARD_WORKERS', '4'))
+FORWARD_MAX_ATTEMPTS = 8
+FORWARD_MAX_BACKOFF = 300
+FORWARD_POLL_INTERVAL = 5
+# Delivered jobs are kept this long so a late double tap still hits their idempotency key, then purged
+FORWARD_DONE_RETENTION = 24 * 3600
+FORWARD_STOP_TIMEOUT = 10
+# sendMediaGroup accepts at most 10 items per call
+MEDIA_GROUP_SIZE = 10
+
+# RETAG_MODE=1 downloads each track, writes genre and sender into its tags and uploads the
+# retagged file instead of copying the original, so saved copies keep their categorization
+RETAG_MODE = os.getenv('RETAG_MODE', '0') == '1'
+RETAG_PROCESSES = int(os.getenv('RETAG_PROCESSES', '2'))
+RETAG_DOWNLOAD_TIMEOUT = 120
+RETAG_CHUNK_SIZE = 256 * 1024
+RETAG_POOL = None
+
+class ForwardQueue:
+    # Durable spool of pending copy_message calls; rows survive restarts and are drained by forward_worker()
+    def __init__(self, db):
+        self.db = db
+        self.wakeup = None
+        self.stopping = False
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS forward_queue ('
+                       'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                       'idempotency_key TEXT UNIQUE NOT NULL, '
+                       'chat_id INTEGER NOT NULL, '
+                       'from_chat_id INTEGER NOT NULL, '
+                       'message_id INTEGER NOT NULL, '
+                       'caption TEXT, '
+                       "status TEXT NOT NULL DEFAULT 'pending', "
+                       'attempts INTEGER NOT NULL DEFAULT 0, '
+                       'next_attempt_at REAL NOT NULL DEFAULT 0, '
+                       'last_error TEXT, '
+                       'created_at REAL NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS forward_queue_due ON forward_queue (status, next_attempt_at)')
+            # Set for album jobs: a JSON list of audio file ids sent with one sendMediaGroup call
+            add_column_if_missing(db, 'forward_queue', 'file_ids', 'TEXT')
+            # Set in retag mode: JSON with the genre, sender and [file_id, file_name] of every track
+            add_column_if_missing(db, 'forward_queue', 'tags', 'TEXT')
+            # Shared by the jobs that send the same tracks to different destinations. `delivery` holds
+            # what to record about the tracks once one of them is delivered, and is cleared on all of them.
+            add_column_if_missing(db, 'forward_queue', 'upload_key', 'TEXT')
+            add_column_if_missing(db, 'forward_queue', 'delivery', 'TEXT')
+            db.execute('CREATE INDEX IF NOT EXISTS forward_queue_upload ON forward_queue (upload_key)')
+        # Jobs per status, kept up to date by every transition so /metrics never has to count rows
+        self.counts = Counter(dict(db.execute('SELECT status, COUNT(*) FROM forward_queue GROUP BY status')))
+        self.release_claimed()
+
+    def release_claimed(self):
+        # Jobs a worker had claimed when the process died, or when on_stop() cancelled it, are handed
+        # out again. Called on import and again by every main() the supervisor loop starts.
+        with self.db:
+            cursor = self.db.execute("UPDATE forward_queue SET status = 'pending' WHERE status = 'sending'")
+        self.counts['sending'] -= cursor.rowcount
+        self.counts['pending'] += cursor.rowcount
+
+    def enqueue(self, key, chat_id, from_chat_id, message_id, caption, file_ids=None, tags=None,
+                upload_key=None, delivery=None) -> bool:
+        with self.db:
+            cursor = self.db.execute('INSERT OR IGNORE INTO forward_queue (idempotency_key, chat_id, from_chat_id, '
+                                     'message_id, caption, file_ids, tags, upload_key, delivery, created_at) '
+                                     'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                     (key, chat_id, from_chat_id, message_id, caption,
+                                      json.dumps(file_ids) if file_ids else None,
+                                      json.dumps(tags) if tags else None, upload_key,
+                                      json.dumps(delivery) if delivery else None, time.time()))
+        self.counts['pending'] += cursor.rowcount
+        if self.wakeup:
+            self.wakeup.set()
+        return cursor.rowcount == 1
+
+    def claim(self):
+        # Workers share one event loop, so select-then-update cannot interleave with another claim
+        row = self.db.execute("SELECT id, chat_id, from_chat_id, message_id, caption, file_ids, tags, attempts "
+                              "FROM forward_queue "
+                              "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT 1",
+                              (time.time(),)).fetchone()
+        if row is None:
+            return None
+        with self.db:
+            self.db.execute("UPDATE forward_queue SET status = 'sending', attempts = attempts + 1 WHERE id = ?",
+                            (row[0],))
+        self.counts['pending'] -= 1
+        self.counts['sending'] += 1
+        return row
+
+    def next_due_in(self) -> float:
+        next_attempt_at = self.db.execute("SELECT MIN(next_attempt_at) FROM forward_queue "
+                                          "WHERE status = 'pending'").fetchone()[0]
+        if next_attempt_at is None:
+            return FORWARD_POLL_INTERVAL
+        return max(0.0, min(FORWARD_POLL_INTERVAL, next_attempt_at - time.time()))
+
+    def complete(self, job_id):
+        # Returns the job's delivery record if no other destination of the same tracks got them first
+        self.counts['sending'] -= 1
+        self.counts['done'] += 1
+        with self.db:
+            self.db.execute("UPDATE forward_queue SET status = 'done', last_error = NULL WHERE id = ?", (job_id,))
+            upload_key, delivery = self.db.execute('SELECT upload_key, delivery FROM forward_queue WHERE id = ?',
+                                                   (job_id,)).fetchone()
+            if delivery is None:
+                return None
+            self.db.execute('UPDATE forward_queue SET delivery = NULL WHERE upload_key = ?', (upload_key,))
+        return json.loads(delivery)
+
+    def retry(self, job_id, delay, error, count_attempt=True):
+        with self.db:
+            self.db.execute("UPDATE forward_queue SET status = 'pending', next_attempt_at = ?, last_error = ?, "
+                            "attempts = attempts - ? WHERE id = ?",
+                            (time.time() + delay, str(error), 0 if count_attempt else 1, job_id))
+        self.counts['sending'] -= 1
+        self.counts['pending'] += 1
+
+    def fail(self, job_id, error):
+        with self.db:
+            self.db.execute("UPDATE forward_queue SET status = 'failed', last_error = ? WHERE id = ?",
+                            (str(error), job_id))
+        self.counts['sending'] -= 1
+        self.counts['failed'] += 1
+
+    def purge_done(self):
+        with self.db:
+            cursor = self.db.execute("DELETE FROM forward_queue WHERE status = 'done' AND created_at < ?",
+                                     (time.time() - FORWARD_DONE_RETENTION,))
+        self.counts['done'] -= cursor.rowcount
+
+    def status_by_chat(self) -> dict:
+        counts = defaultdict(Counter)
+        for chat_id, status, count in self.db.execute('SELECT chat_id, status, COUNT(*) FROM forward_queue '
+                                                      'GROUP BY chat_id, status'):
+            counts[chat_id][status] = count
+        return counts
+
+FORWARD_QUEUE = ForwardQueue(DB)
+
+# DUPLICATE_POLICY=reject skips tracks already shared in the group, =flag only warns the uploader
+DUPLICATE_POLICY = os.getenv('DUPLICATE_POLICY', 'reject')
+TRACK_INDEX_CAPACITY = int(os.getenv('TRACK_INDEX_CAPACITY', '1000000'))
+
+class BloomFilter:
+    # About 1% false positives at `capacity` keys; a miss is definite, a hit has to be confirmed
+    def __init__(self, capacity, hashes=7):
+        self.size = capacity * 10
+        self.hashes = hashes
+        self.bits = bytearray(self.size // 8 + 1)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+def normalize(text):
+    return ' '.join(re.sub(r'[^\w\s]', ' ', text or '').lower().split())
+
+def track_keys(audio) -> list:
+    # The same file re-sent keeps its file_unique_id; a re-encode or rip of the same song usually
+    # still matches on performer, title and length
+    keys = [f"u:{audio.file_unique_id}"]
+    if audio.title:
+        keys.append(f"m:{normalize(audio.performer)}|{normalize(audio.title)}|{audio.duration}")
+    return keys
+
+class TrackIndex:
+    # Keys of every track forwarded so far. The Bloom filter answers most lookups for new tracks
+    # from memory; only filter hits are checked against the table.
+    def __init__(self, db, capacity):
+        self.db = db
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS known_tracks (key TEXT PRIMARY KEY, first_seen REAL NOT NULL)')
+        self.bloom = BloomFilter(capacity)
+        for (key,) in db.execute('SELECT key FROM known_tracks'):
+            self.bloom.add(key)
+
+    def contains(self, keys) -> bool:
+        for key in keys:
+            if key in self.bloom and self.db.execute('SELECT 1 FROM known_tracks WHERE key = ?', (key,)).fetchone():
+                return True
+        return False
+
+    def remember(self, keys):
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO known_tracks (key, first_seen) VALUES (?, ?)',
+                                [(key, now) for key in keys])
+        for key in keys:
+            self.bloom.add(key)
+
+TRACK_INDEX = TrackIndex(DB, TRACK_INDEX_CAPACITY)
+
+# A genre is only suggested once the model has seen enough forwards and is fairly sure
+GENRE_MODEL_MIN_TRACKS = 20
+GENRE_SUGGESTION_THRESHOLD = 0.6
+PERFORMER_MIN_TRACKS = 2
+PERFORMER_AGREEMENT = 0.8
+
+class GenreModel:
+    # Naive Bayes over words from performer, title and file name plus a length bucket, learned from
+    # past forwards. All counts are kept in memory; each forward is written through to SQLite.
+    def __init__(self, db):
+        self.db = db
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS genre_model ('
+                       'token TEXT NOT NULL, genre TEXT NOT NULL, count INTEGER NOT NULL, '
+                       'PRIMARY KEY (token, genre))')
+        self.token_counts = defaultdict(Counter)
+        self.genre_tracks = Counter()
+        self.genre_tokens = Counter()
+        for token, genre, count in db.execute('SELECT token, genre, count FROM genre_model'):
+            self.add_count(token, genre, count)
+        self.performer_cache = {}
+
+    def add_count(self, token, genre, count):
+        if token == '#tracks':
+            self.genre_tracks[genre] += count
+        else:
+            self.token_counts[token][genre] += count
+            self.genre_tokens[genre] += count
+
+    @staticmethod
+    def tokens(track) -> list:
+        file_name = os.path.splitext(track.get('file_name') or '')[0]
+        words = normalize(f"{track.get('performer') or ''} {track.get('title') or ''} {file_name}").split()
+        tokens = {f"w:{word}" for word in words if len(word) > 1}
+        if track.get('performer'):
+            tokens.add(f"p:{normalize(track['performer'])}")
+        if track.get('duration'):
+            tokens.add(f"d:{min(track['duration'] // 60, 10)}")
+        return sorted(tokens)
+
+    def learn(self, tracks, genre):
+        counts = Counter()
+        for track in tracks:
+            counts.update(self.tokens(track))
+            counts['#tracks'] += 1
+            self.performer_cache.pop(normalize(track.get('performer')), None)
+        for token, count in counts.items():
+            self.add_count(token, genre, count)
+        with self.db:
+            self.db.executemany('INSERT INTO genre_model (token, genre, count) VALUES (?, ?, ?) '
+                                'ON CONFLICT(token, genre) DO UPDATE SET count = count + excluded.count',
+                                [(token, genre, count) for token, count in counts.items()])
+
+    def performer_genre(self, performer):
+        # Most performers are only ever tagged with one genre, which is a better signal than any word
+        key = normalize(performer)
+        if key not in self.performer_cache:
+            counts = self.token_counts.get(f"p:{key}") if key else None
+            genre = None
+            if counts:
+                best, count = counts.most_common(1)[0]
+                if count >= PERFORMER_MIN_TRACKS and count / sum(counts.values()) >= PERFORMER_AGREEMENT:
+                    genre = best
+            self.performer_cache[key] = genre
+        return self.performer_cache[key]
+
+    def suggest(self, tracks):
+        performer_genres = {self.performer_genre(track.get('performer')) for track in tracks}
+        if len(performer_genres) == 1 and None not in performer_genres:
+            return performer_genres.pop()
+
+        total_tracks = sum(self.genre_tracks.values())
+        if total_tracks < GENRE_MODEL_MIN_TRACKS:
+            return None
+        tokens = [token for track in tracks for token in self.tokens(track)]
+        vocabulary = len(self.token_counts)
+        scores = {}
+        for genre, genre_tracks in self.genre_tracks.items():
+            score = math.log(genre_tracks / total_tracks)
+            denominator = self.genre_tokens[genre] + vocabulary
+            for token in tokens:
+                counts = self.token_counts.get(token)
+                score += math.log(((counts[genre] if counts else 0) + 1) / denominator)
+            scores[genre] = score
+        best = max(scores, key=scores.get)
+        # Posterior of the best genre, computed relative to the top score to avoid underflow
+        confidence = 1 / sum(math.exp(score - scores[best]) for score in scores.values())
+        return best if confidence >= GENRE_SUGGESTION_THRESHOLD else None
+
+GENRE_MODEL = GenreModel(DB)
+
+# Forwards are rolled up into hourly and daily buckets (UTC) per genre and per user, so a /stats
+# query reads one row per bucket and key instead of every forward ever made
+HOUR = 3600
+DAY = 86400
+HOURLY_RETENTION = 14 * DAY
+
+class Analytics:
+    def __init__(self, db):
+        self.db = db
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS forward_stats ('
+                       'granularity INTEGER NOT NULL, bucket INTEGER NOT NULL, dimension TEXT NOT NULL, '
+                       'key TEXT NOT NULL, uploads INTEGER NOT NULL, duration INTEGER NOT NULL, '
+                       'PRIMARY KEY (granularity, dimension, bucket, key)) WITHOUT ROWID')
+        self.uploads = Counter()
+        self.durations = Counter()
+
+    def record(self, user_id, genre, duration, timestamp=None):
+        # In-memory only; written out by flush() together with the interaction counters
+        timestamp = int(timestamp or time.time())
+        for granularity in (HOUR, DAY):
+            bucket = timestamp - timestamp % granularity
+            for dimension, key in (('genre', genre), ('user', str(user_id))):
+                self.uploads[(granularity, dimension, bucket, key)] += 1
+                self.durations[(granularity, dimension, bucket, key)] += duration or 0
+
+    def flush(self):
+        if not self.uploads:
+            return
+        uploads, self.uploads = self.uploads, Counter()
+        durations, self.durations = self.durations, Counter()
+        with self.db:
+            self.db.executemany('INSERT INTO forward_stats (granularity, dimension, bucket, key, uploads, duration) '
+                                'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(granularity, dimension, bucket, key) DO UPDATE '
+                                'SET uploads = uploads + excluded.uploads, duration = duration + excluded.duration',
+                                [(*row, count, durations[row]) for row, count in uploads.items()])
+            self.db.execute('DELETE FROM forward_stats WHERE granularity = ? AND bucket < ?',
+                            (HOUR, int(time.time()) - HOURLY_RETENTION))
+
+    def query(self, dimension, since, limit=None) -> list:
+        self.flush()
+        # Hourly buckets for short windows, daily ones otherwise
+        granularity = HOUR if time.time() - since <= 2 * DAY else DAY
+        since -= since % granularity
+        sql = ('SELECT key, SUM(uploads) AS total, SUM(duration) FROM forward_stats '
+               'WHERE granularity = ? AND dimension = ? AND bucket >= ? GROUP BY key ORDER BY total DESC')
+        parameters = [granularity, dimension, since]
+        if limit:
+            sql += ' LIMIT ?'
+            parameters.append(limit)
+        return self.db.execute(sql, parameters).fetchall()
+
+ANALYTICS = Analytics(DB)
+
+SEARCH_RESULTS = 5
+
+class Catalog:
+    # Every forwarded track with a full-text index over its metadata. The FTS5 table only stores the
+    # index; triggers keep it in step with the catalog rows.
+    def __init__(self, db):
+        self.db = db
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS catalog ('
+                       'id INTEGER PRIMARY KEY, file_id TEXT NOT NULL, file_unique_id TEXT UNIQUE NOT NULL, '
+                       'performer TEXT, title TEXT, file_name TEXT, genre TEXT NOT NULL, '
+                       'sender_id INTEGER NOT NULL, sender_name TEXT, date REAL NOT NULL)')
+            db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS catalog_fts USING fts5("
+                       "performer, title, file_name, genre, content='catalog', content_rowid='id', "
+                       "tokenize='unicode61 remove_diacritics 2')")
+            db.execute('CREATE TRIGGER IF NOT EXISTS catalog_insert AFTER INSERT ON catalog BEGIN '
+                       'INSERT INTO catalog_fts (rowid, performer, title, file_name, genre) '
+                       'VALUES (new.id, new.performer, new.title, new.file_name, new.genre); END')
+            db.execute('CREATE TRIGGER IF NOT EXISTS catalog_delete AFTER DELETE ON catalog BEGIN '
+                       "INSERT INTO catalog_fts (catalog_fts, rowid, performer, title, file_name, genre) "
+                       "VALUES ('delete', old.id, old.performer, old.title, old.file_name, old.genre); END")
+
+    def add(self, tracks, genre, sender_id, sender_name):
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO catalog (file_id, file_unique_id, performer, title, file_name, '
+                                'genre, sender_id, sender_name, date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                [(track['file_id'], track['file_unique_id'], track.get('performer'),
+                                  track.get('title'), track.get('file_name'), genre, sender_id, sender_name, now)
+                                 for track in tracks if track.get('file_unique_id')])
+
+    @staticmethod
+    def match_expression(text, genre=None):
+        # Every word must match as a prefix; quoting keeps user input from being read as FTS syntax.
+        # Words are split the way the unicode61 tokenizer splits them, so 'Foo - Bar' does not turn
+        # the dash into an empty phrase that matches nothing
+        terms = [f'"{word}"*' for word in re.findall(r'\w+', text)]
+        # The genre comes from a hashtag the user typed, so it is split into words the same way
+        genre_words = re.findall(r'\w+', genre or '')
+        if genre_words:
+            terms.append(f'genre : "{" ".join(genre_words)}"')
+        return ' AND '.join(terms)
+
+    def search(self, text, genre=None, limit=SEARCH_RESULTS, offset=0) -> list:
+        expression = self.match_expression(text, genre)
+        if not expression:
+            return []
+        return self.db.execute('SELECT catalog.file_id, catalog.performer, catalog.title, catalog.genre, '
+                               'catalog.sender_name, catalog.id FROM catalog_fts '
+                               'JOIN catalog ON catalog.id = catalog_fts.rowid '
+                               'WHERE catalog_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?',
+                               (expression, limit, offset)).fetchall()
+
+    def recent(self, limit, offset=0) -> list:
+        return self.db.execute('SELECT file_id, performer, title, genre, sender_name, id FROM catalog '
+                               'ORDER BY id DESC LIMIT ? OFFSET ?', (limit, offset)).fetchall()
+
+CATALOG = Catalog(DB)
+
+# Inline queries arrive on every keystroke; identical queries within INLINE_CACHE_TTL seconds are
+# answered from memory
+INLINE_PAGE_SIZE = 20
+INLINE_CACHE_SIZE = 1000
+INLINE_CACHE_TTL = 60
+
+class LRUCache:
+    def __init__(self, capacity, ttl):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        stored_at, value = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+INLINE_CACHE = LRUCache(INLINE_CACHE_SIZE, INLINE_CACHE_TTL)
+FORWARD_WORKER_TASKS = []
+
+ADD_USER, REMOVE_USER, BROADCAST, IMPORT_USERS = range(4)
+
+# Telegram user ids are positive and fit in 52 bits
+MAX_USER_ID = 2 ** 52
+
+# FLOW_MODE=edit walks one message through genre -> confirm -> done by editing it in place;
+# FLOW_MODE=classic deletes and re-sends a message at every step like earlier versions did
+FLOW_MODE = os.getenv('FLOW_MODE', 'edit')
+
+# Outgoing Bot API calls by method, excluding getUpdates, so flow changes can be measured
+API_CALLS = Counter()
+
+class CountingRequest(HTTPXRequest):
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        if method == 'POST':
+            API_CALLS[url.rsplit('/', 1)[-1]] += 1
+        return await super().do_request(url, method, request_data, *args, **kwargs)
+
+# Latency buckets in seconds, from a cached reply to a slow upload
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q) -> float:
+        # Interpolated within the bucket the q-th observation falls in, like Prometheus' histogram_quantile
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = LATENCY_BUCKETS[index - 1] if index else 0.0
+                upper = LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else LATENCY_BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return LATENCY_BUCKETS[-1]
+
+class Metrics:
+    # Plain dicts and counters updated inline; the text format is only built when /metrics is scraped
+    def __init__(self):
+        self.started = time.time()
+        self.handler_latency = defaultdict(Histogram)
+        self.handler_errors = Counter()
+        self.step_latency = defaultdict(Histogram)
+        self.api_latency = defaultdict(Histogram)
+        self.api_errors = Counter()
+        self.api_retry_after = Counter()
+        # Uploads waiting for a genre across all users; see keep_pending()
+        self.pending_uploads = 0
+
+    def timed(self, step):
+        # For the stages handlers hand work to (forward_music, a spool job) rather than handlers themselves
+        def decorator(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    self.step_latency[step].observe(time.perf_counter() - started)
+            return wrapper
+        return decorator
+
+    def gauges(self, application) -> dict:
+        # Only counters kept up to date as things happen, so a scrape costs the same whatever the backlog
+        forward_jobs = FORWARD_QUEUE.counts
+        scheduler = application.bot.rate_limiter
+        return {
+            'telebot_update_queue_size': application.update_queue.qsize(),
+            'telebot_api_scheduler_queue_size': len(scheduler.queue) if isinstance(scheduler, ApiScheduler) else 0,
+            'telebot_forward_jobs_pending': forward_jobs['pending'] + forward_jobs['sending'],
+            'telebot_forward_jobs_failed': forward_jobs['failed'],
+            'telebot_broadcast_recipients_pending': sum(BROADCASTS.pending.values()),
+            'telebot_pending_uploads': self.pending_uploads,
+            'telebot_users_in_memory': len(application.user_data),
+            'telebot_orphaned_keyboards': len(ORPHANED_KEYBOARDS),
+        }
+
+    def render(self, application) -> str:
+        lines = []
+
+        def histograms(name, label, histograms):
+            lines.append(f"# TYPE {name} histogram")
+            for value, histogram in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{label}="{value}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{{label}="{value}"}} {histogram.total:.6f}')
+                lines.append(f'{name}_count{{{label}="{value}"}} {histogram.count}')
+
+        def counters(name, label, counter):
+            lines.append(f"# TYPE {name} counter")
+            for value, count in sorted(counter.items()):
+                lines.append(f'{name}{{{label}="{value}"}} {count}')
+
+        histograms('telebot_handler_seconds', 'handler', self.handler_latency)
+        counters('telebot_handler_errors_total', 'handler', self.handler_errors)
+        histograms('telebot_step_seconds', 'step', self.step_latency)
+        histograms('telebot_api_seconds', 'method', self.api_latency)
+        counters('telebot_api_errors_total', 'method', self.api_errors)
+        counters('telebot_api_retry_after_total', 'method', self.api_retry_after)
+        for name, value in self.gauges(application).items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        lines.append("# TYPE telebot_uptime_seconds gauge")
+        lines.append(f"telebot_uptime_seconds {time.time() - self.started:.0f}")
+        return '\n'.join(lines) + '\n'
+
+METRICS = Metrics()
+METRICS_RUNNERS = []
+
+async def metrics_handler(request) -> 'web.Response':
+    return web.Response(text=METRICS.render(request.app['application']), content_type='text/plain', charset='utf-8')
+
+# How often GENRES_FILE and ROUTES_FILE are checked for changes
+CONFIG_RELOAD_INTERVAL = 10
+
+class JsonConfigFile:
+    # A JSON file that is re-read when its mtime changes, checked at most every CONFIG_RELOAD_INTERVAL
+    # seconds. Subclasses validate the content in parse() and take it in load(); a file that fails
+    # to parse is logged and the last good content stays in use.
+    kind = 'config'
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.checked = 0.0
+
+    def parse(self, content):
+        return content
+
+    def load(self, config):
+        raise NotImplementedError
+
+    def missing(self):
+        pass
+
+    def reload_if_changed(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.checked < CONFIG_RELOAD_INTERVAL:
+            return
+        self.checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            self.mtime = None
+            self.missing()
+            return
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        try:
+            with open(self.path, 'r') as file:
+                config = self.parse(json.load(file))
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning("Ignoring invalid %s file %s: %s", self.kind, self.path, e)
+            return
+        self.load(config)
+
+# Genres are read from GENRES_FILE (a JSON list) and re-read when the file changes, no restart needed
+GENRES_FILE = os.getenv('GENRES_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'genres.json'))
+GENRES_PER_PAGE = 10
+DEFAULT_GENRES = [
+    "#Chill", "#Latin", "#Dance", "#HipHop", "#HIGH_TEMPO",
+    "#FA_VINTAGE", "#EN_VINTAGE", "#Birthday", "#AfterParty",
+    "#Khaltoor", "#Arabic", "#Turki", "#Pop_Chosnale", "#Indian"
+]
+
+class GenreRegistry(JsonConfigFile):
+    # Keyboards are built once per version of the genre list and reused for every upload.
+    # Buttons carry "g:<version>:<index>", so a keyboard sent before a reload still resolves to
+    # the genre it showed. Without the file the last list loaded stays in use.
+    kind = 'genres'
+
+    def __init__(self, path, defaults):
+        super().__init__(path)
+        self.versions = {}
+        self.load(defaults)
+        self.reload_if_changed(force=True)
+
+    def load(self, genres):
+        self.genres = genres
+        self.version = hashlib.sha1('\n'.join(genres).encode()).hexdigest()[:6]
+        self.versions[self.version] = genres
+        self.indexes = {genre.lstrip('#'): index for index, genre in enumerate(genres)}
+        self.pages = []
+        page_count = max(1, -(-len(genres) // GENRES_PER_PAGE))
+        for page in range(page_count):
+            start = page * GENRES_PER_PAGE
+            buttons = [InlineKeyboardButton(genre, callback_data=f'g:{self.version}:{index}')
+                       for index, genre in enumerate(genres[start:start + GENRES_PER_PAGE], start)]
+            rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+            navigation = []
+            if page > 0:
+                navigation.append(InlineKeyboardButton("< Previous", callback_data=f'p:{self.version}:{page - 1}'))
+            if page < page_count - 1:
+                navigation.append(InlineKeyboardButton("Next >", callback_data=f'p:{self.version}:{page + 1}'))
+            if navigation:
+                rows.append(navigation)
+            self.pages.append(InlineKeyboardMarkup(rows))
+
+    def parse(self, genres):
+        if not isinstance(genres, list) or not genres or not all(isinstance(genre, str) and genre.strip()
+                                                                 for genre in genres):
+            raise ValueError("expected a non-empty list of genre names")
+        return [genre.strip() for genre in genres]
+
+    def keyboard(self, page=0) -> InlineKeyboardMarkup:
+        self.reload_if_changed()
+        return self.pages[min(page, len(self.pages) - 1)]
+
+    def suggestion_row(self, genre_name):
+        index = self.indexes.get(genre_name)
+        if index is None:
+            return []
+        return [[InlineKeyboardButton(f"{self.genres[index]} (suggested, forward now)",
+                                      callback_data=f's:{self.version}:{index}')]]
+
+    def resolve(self, version, index):
+        genres = self.versions.get(version)
+        if genres is None or not 0 <= index < len(genres):
+            return None
+        return genres[index]
+
+GENRES = GenreRegistry(GENRES_FILE, DEFAULT_GENRES)
+
+# ROUTES_FILE maps genres to the chats their tracks are copied to, e.g.
+# {"#Birthday": [-100111, -100222], "*": [-100333]}; "*" catches every genre not listed.
+# Without the file everything goes to GROUP_CHAT_ID.
+ROUTES_FILE = os.getenv('ROUTES_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'routes.json'))
+
+class RouteTable(JsonConfigFile):
+    kind = 'routes'
+
+    def __init__(self, path, default_chat_id):
+        super().__init__(path)
+        self.default = {'*': [default_chat_id]}
+        self.routes = self.default
+        self.reload_if_changed(force=True)
+
+    def parse(self, routes):
+        if not isinstance(routes, dict):
+            raise ValueError("expected an object of genre -> list of chat ids")
+        # Genre keys match with or without the leading # and in any case
+        return {genre.strip().lstrip('#').lower():
+                    [int(chat_id) for chat_id in (targets if isinstance(targets, list) else [targets])]
+                for genre, targets in routes.items()}
+
+    def load(self, routes):
+        self.routes = routes
+
+    def missing(self):
+        self.routes = self.default
+
+    def targets(self, genre_name) -> list:
+        self.reload_if_changed()
+        # A genre the file does not list (or lists without chats) goes to "*", and without that to
+        # GROUP_CHAT_ID, so no route file can leave an upload with nowhere to go
+        targets = (self.routes.get(genre_name.lstrip('#').lower()) or self.routes.get('*')
+                   or self.default['*'])
+        # Keep the configured order but never copy twice to the same chat
+        return list(dict.fromkeys(targets))
+
+ROUTES = RouteTable(ROUTES_FILE, GROUP_CHAT_ID)
+
+# Audios from one user that arrive within BATCH_WINDOW seconds of each other (albums and
+# multi-file uploads) are tagged and forwarded together
+BATCH_WINDOW = 2.0
+BATCH_MAX_SIZE = 50
+
+# Uploads nobody picked a genre for expire after PENDING_TTL seconds; their keyboards are then
+# closed a batch at a time by the sweeper so they can't forward a stale file
+PENDING_TTL = int(os.getenv('PENDING_TTL', str(24 * 3600)))
+PENDING_MAX_PER_USER = 20
+PENDING_SWEEP_INTERVAL = 300
+ORPHAN_CLEANUP_BATCH = 30
+ORPHANED_KEYBOARDS = []
+
+# Telegram allows roughly 30 messages per second overall, one message per second to the same
+# chat and 20 messages per minute to the same group
+API_RATE = 30
+PRIVATE_CHAT_INTERVAL = 1.0
+GROUP_CHAT_INTERVAL = 3.0
+API_MAX_RETRIES = 3
+
+# Priority classes for ApiScheduler; lower goes first. Pass them as rate_limit_args to bot methods,
+# calls without one (e.g. reply_text from a handler) are interactive.
+PRIORITY_INTERACTIVE, PRIORITY_FORWARD, PRIORITY_BULK = range(3)
+
+BROADCAST_CONCURRENCY = 20
+BROADCAST_MAX_RETRIES = 3
+BROADCAST_PER_CHAT_INTERVAL = 1.0
+BROADCAST_PROGRESS_INTERVAL = 5
+
+class TokenBucket:
+    # Hands out `rate` tokens per second; pause() stops all takers after a flood wait
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    delay = error.retry_after
+    return delay.total_seconds() if isinstance(delay, timedelta) else delay
+
+class ApiScheduler(BaseRateLimiter):
+    # Every Bot API call made through the Application's bot passes through here. Sending calls
+    # first wait for their chat's next free slot, then all calls queue for one global token bucket
+    # and are let through in priority order: interactive replies, then forwards, then broadcasts
+    # and cleanup. A RetryAfter pauses the bucket once for everybody instead of each queued call
+    # running into its own 429.
+    def __init__(self):
+        self.bucket = None
+        self.queue = []
+        self.sequence = itertools.count()
+        self.wakeup = None
+        self.dispatcher = None
+        self.chat_next_slot = {}
+
+    async def initialize(self) -> None:
+        # The Application and its Updater both initialize the same bot
+        if self.dispatcher is not None:
+            return
+        self.bucket = TokenBucket(API_RATE)
+        self.wakeup = asyncio.Event()
+        self.dispatcher = asyncio.create_task(self.dispatch())
+
+    async def shutdown(self) -> None:
+        if self.dispatcher:
+            self.dispatcher.cancel()
+            await asyncio.gather(self.dispatcher, return_exceptions=True)
+            self.dispatcher = None
+        for _, _, future in self.queue:
+            future.cancel()
+        self.queue.clear()
+
+    async def dispatch(self):
+        while True:
+            while not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            await self.bucket.acquire()
+            while self.queue:
+                _, _, future = heapq.heappop(self.queue)
+                if not future.done():
+                    future.set_result(None)
+                    break
+
+    async def wait_for_chat(self, chat_id, priority):
+        # Replies to a user's own action may burst; everything else keeps one message per second
+        # per private chat. Groups are always held to their per-minute limit.
+        is_group = str(chat_id).startswith('-')
+        if not is_group and priority == PRIORITY_INTERACTIVE:
+            return
+        now = time.monotonic()
+        interval = GROUP_CHAT_INTERVAL if is_group else PRIVATE_CHAT_INTERVAL
+        slot = max(now, self.chat_next_slot.get(chat_id, 0.0))
+        self.chat_next_slot[chat_id] = slot + interval
+        if len(self.chat_next_slot) > 10000:
+            self.chat_next_slot = {chat: next_slot for chat, next_slot in self.chat_next_slot.items()
+                                   if next_slot > now}
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def wait_for_turn(self, priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (priority, next(self.sequence), future))
+        self.wakeup.set()
+        await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = PRIORITY_INTERACTIVE if rate_limit_args is None else rate_limit_args
+        chat_id = data.get('chat_id')
+        # Only new messages count against the per-chat limits; edits, deletes and answers do not
+        sends_message = endpoint.startswith(('send', 'copy', 'forward'))
+        # Timed from the caller's point of view, so time spent waiting for a slot counts too
+        started = time.perf_counter()
+        try:
+            for attempt in range(API_MAX_RETRIES + 1):
+                if sends_message and chat_id is not None:
+                    await self.wait_for_chat(chat_id, priority)
+                await self.wait_for_turn(priority)
+                try:
+                    return await callback(*args, **kwargs)
+                except RetryAfter as e:
+                    METRICS.api_retry_after[endpoint] += 1
+                    if attempt == API_MAX_RETRIES:
+                        raise
+                    self.bucket.pause(retry_after_seconds(e))
+        except TelegramError:
+            METRICS.api_errors[endpoint] += 1
+            raise
+        finally:
+            METRICS.api_latency[endpoint].observe(time.perf_counter() - started)
+
+BROADCAST_STOP_TIMEOUT = 10
+
+class BroadcastStore:
+    # A broadcast is a persisted job with one row per recipient. Rows are marked as soon as their
+    # message is sent, so after a restart the job carries on with the rows still pending.
+    def __init__(self, db):
+        self.db = db
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS broadcasts ('
+                       'id INTEGER PRIMARY KEY AUTOINCREMENT, message TEXT NOT NULL, '
+                       'report_chat_id INTEGER NOT NULL, created_at TEXT NOT NULL, status TEXT NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS broadcast_recipients ('
+                       'broadcast_id INTEGER NOT NULL, user_id INTEGER NOT NULL, '
+                       "status TEXT NOT NULL DEFAULT 'pending', error TEXT, "
+                       'PRIMARY KEY (broadcast_id, user_id)) WITHOUT ROWID')
+        self.statuses = dict(db.execute("SELECT id, status FROM broadcasts WHERE status IN ('running', 'paused')"))
+        # Recipients still to be sent to, per running or paused broadcast
+        self.pending = Counter({broadcast_id: self.counts(broadcast_id)['pending'] for broadcast_id in self.statuses})
+        self.tasks = {}
+        self.stopping = False
+
+    def create(self, message, report_chat_id, user_ids) -> int:
+        with self.db:
+            cursor = self.db.execute("INSERT INTO broadcasts (message, report_chat_id, created_at, status) "
+                                     "VALUES (?, ?, ?, 'running')",
+                                     (message, report_chat_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            self.db.executemany('INSERT INTO broadcast_recipients (broadcast_id, user_id) VALUES (?, ?)',
+                                [(cursor.lastrowid, user_id) for user_id in user_ids])
+        self.statuses[cursor.lastrowid] = 'running'
+        self.pending[cursor.lastrowid] = len(user_ids)
+        return cursor.lastrowid
+
+    def get(self, broadcast_id):
+        return self.db.execute('SELECT id, message, report_chat_id, created_at, status FROM broadcasts WHERE id = ?',
+                               (broadcast_id,)).fetchone()
+
+    def recent(self, limit=10):
+        return self.db.execute('SELECT id, message, report_chat_id, created_at, status FROM broadcasts '
+                               'ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+
+    def status(self, broadcast_id):
+        return self.statuses.get(broadcast_id)
+
+    def set_status(self, broadcast_id, status):
+        with self.db:
+            self.db.execute('UPDATE broadcasts SET status = ? WHERE id = ?', (status, broadcast_id))
+        if status in ('running', 'paused'):
+            self.statuses[broadcast_id] = status
+        else:
+            self.statuses.pop(broadcast_id, None)
+            self.pending.pop(broadcast_id, None)
+
+    def pending_recipients(self, broadcast_id) -> list:
+        return [user_id for (user_id,) in self.db.execute(
+            "SELECT user_id FROM broadcast_recipients WHERE broadcast_id = ? AND status = 'pending' ORDER BY user_id",
+            (broadcast_id,))]
+
+    def mark(self, broadcast_id, user_id, status, error=None):
+        with self.db:
+            cursor = self.db.execute("UPDATE broadcast_recipients SET status = ?, error = ? "
+                                     "WHERE broadcast_id = ? AND user_id = ? AND status = 'pending'",
+                                     (status, error, broadcast_id, user_id))
+        if broadcast_id in self.pending:
+            self.pending[broadcast_id] -= cursor.rowcount
+
+    def counts(self, broadcast_id) -> Counter:
+        return Counter(dict(self.db.execute('SELECT status, COUNT(*) FROM broadcast_recipients '
+                                            'WHERE broadcast_id = ? GROUP BY status', (broadcast_id,))))
+
+BROADCASTS = BroadcastStore(DB)
+
+def start_broadcast_task(bot, broadcast_id, resumed=False):
+    task = asyncio.create_task(run_broadcast(bot, broadcast_id, resumed))
+    BROADCASTS.tasks[broadcast_id] = task
+
+    def finished(task):
+        BROADCASTS.tasks.pop(broadcast_id, None)
+        if not task.cancelled() and task.exception():
+            # The job is still marked running, so /resume_broadcast or the next start picks it up again
+            logger.error("Broadcast %s stopped", broadcast_id, exc_info=task.exception())
+
+    task.add_done_callback(finished)
+
+async def run_broadcast(bot, broadcast_id, resumed=False) -> None:
+    _, text, report_chat_id, _, _ = BROADCASTS.get(broadcast_id)
+    user_ids = BROADCASTS.pending_recipients(broadcast_id)
+    counts = BROADCASTS.counts(broadcast_id)
+    results = {'delivered': counts['sent'], 'failed': counts['failed']}
+    total = sum(counts.values())
+    if resumed:
+        intro = f"Resuming broadcast #{broadcast_id}: {len(user_ids)} of {total} users left..."
+    else:
+        intro = f"Broadcasting #{broadcast_id} to {total} users..."
     try:
-        with open('allowed_users.txt', 'r') as file:
-            return {int(line.split()[0]): line.split()[1] if len(line.split()) > 1 else "Unknown" for line in file if line.strip()}
-    except FileNotFoundError:
-        with open('allowed_users.txt', 'w') as file:
+        progress_message = await bot.send_message(chat_id=report_chat_id, text=intro)
+    except TelegramError as e:
+        # An unreachable report chat is no reason to hold back the broadcast; it just goes without progress
+        logger.warning("Failed to report broadcast %s progress: %s", broadcast_id, e)
+        progress_message = None
+    last_progress = time.monotonic()
+
+    async def report_progress():
+        nonlocal last_progress
+        if progress_message is None or time.monotonic() - last_progress < BROADCAST_PROGRESS_INTERVAL:
+            return
+        last_progress = time.monotonic()
+        done = results['delivered'] + results['failed']
+        try:
+            await progress_message.edit_text(f"Broadcasting #{broadcast_id}... {done}/{total} "
+                                             f"(delivered: {results['delivered']}, failed: {results['failed']})")
+        except TelegramError as e:
+            logger.warning("Failed to update broadcast %s progress: %s", broadcast_id, e)
+
+    def should_stop():
+        return BROADCASTS.stopping or BROADCASTS.status(broadcast_id) != 'running'
+
+    async def deliver(user_id):
+        attempt = 0
+        while True:
+            try:
+                await bot.send_message(chat_id=user_id, text=text, rate_limit_args=PRIORITY_BULK)
+            except RetryAfter as e:
+                # ApiScheduler already waited out and retried flood waits; this is one that kept coming
+                error, delay = e, retry_after_seconds(e)
+            except (Forbidden, BadRequest) as e:
+                # Blocked the bot, deactivated or never started it: retrying will not help
+                error, delay = e, None
+            except NetworkError as e:
+                error, delay = e, max(BROADCAST_PER_CHAT_INTERVAL, 2 ** attempt)
+            except Exception as e:
+                # e.g. ChatMigrated: this recipient failed, the broadcast carries on
+                if not isinstance(e, TelegramError):
+                    logger.exception("Broadcast %s failed unexpectedly for %s", broadcast_id, user_id)
+                error, delay = e, None
+            else:
+                results['delivered'] += 1
+                BROADCASTS.mark(broadcast_id, user_id, 'sent')
+                break
+            attempt += 1
+            if delay is None or attempt > BROADCAST_MAX_RETRIES:
+                results['failed'] += 1
+                BROADCASTS.mark(broadcast_id, user_id, 'failed', str(error))
+                logger.warning("Broadcast %s failed for %s: %s", broadcast_id, user_id, error)
+                break
+            if should_stop():
+                # Leave the recipient pending so a resume picks it up again
+                break
+            await asyncio.sleep(delay)
+
+    async def worker(recipients):
+        # Workers share one iterator, which doubles as the delivery cursor
+        for user_id in recipients:
+            if should_stop():
+                return
+            await deliver(user_id)
+            await report_progress()
+
+    # A pause followed quickly by a resume can leave recipients behind; go around until none are pending
+    while user_ids:
+        recipients = iter(user_ids)
+        workers = [asyncio.create_task(worker(recipients)) for _ in range(BROADCAST_CONCURRENCY)]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            # e.g. the database failing in mark(): stop every worker before the task ends, or they would
+            # keep sending next to the run a /resume_broadcast starts over the same pending rows
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            raise
+        if should_stop():
+            break
+        user_ids = BROADCASTS.pending_recipients(broadcast_id)
+
+    status = BROADCASTS.status(broadcast_id)
+    if BROADCASTS.stopping:
+        return
+    if status == 'running':
+        BROADCASTS.set_status(broadcast_id, 'done')
+        summary = (f"Broadcast #{broadcast_id} finished: {results['delivered']} delivered, "
+                   f"{results['failed']} failed out of {total} users.")
+    else:
+        summary = (f"Broadcast #{broadcast_id} {status or 'cancelled'}: {results['delivered']} delivered, "
+                   f"{results['failed']} failed, {total - results['delivered'] - results['failed']} not sent.")
+    if progress_message is not None:
+        try:
+            await progress_message.edit_text(summary)
+            return
+        except TelegramError:
             pass
-        return {ADMIN_USER_ID: datetime.now().strftime('%Y-%m-%d')}
+    try:
+        await bot.send_message(chat_id=report_chat_id, text=summary)
+    except TelegramError as e:
+        logger.warning("Failed to send broadcast %s summary: %s", broadcast_id, e)
+
+async def correlate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Registered in group -2, ahead of the auth gate, so every record logged for an update carries its ids
+    CORRELATION.set({
+        'update_id': update.update_id,
+        'user_id': update.effective_user.id if update.effective_user else None,
+        'chat_id': update.effective_chat.id if update.effective_chat else None,
+    })
 
-# Save allowed users back to the file
-def save_allowed_users():
-    with open('allowed_users.txt', 'w') as file:
-        for user_id, date_added in ALLOWED_USERS.items():
-            file.write(f"{user_id} {date_added}\n")
+def traced(callback):
+    # Adds the handler name to the correlation ids, and logs and records how long the handler took
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        token = CORRELATION.set({**CORRELATION.get(), 'handler': callback.__name__})
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            METRICS.handler_errors[callback.__name__] += 1
+            logger.exception("Handler failed")
+        finally:
+            duration = time.perf_counter() - started
+            METRICS.handler_latency[callback.__name__].observe(duration)
+            logger.info("Handled update", extra={'fields': {'duration_ms': round(duration * 1000, 1)}})
+            CORRELATION.reset(token)
+    return wrapper
 
-ALLOWED_USERS = load_allowed_users()
-USER_INTERACTIONS = {user_id: 0 for user_id in ALLOWED_USERS}
-BROADCAST_HISTORY = []
+def trace_handlers(handlers) -> None:
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            trace_handlers(handler.entry_points + handler.fallbacks
+                           + [state_handler for state_handlers in handler.states.values()
+                              for state_handler in state_handlers])
+        else:
+            handler.callback = traced(handler.callback)
 
-ADD_USER, REMOVE_USER, BROADCAST = range(3)
+# Outsiders get at most one "not authorized" reply per DENIAL_WINDOW seconds, whatever they send
+DENIAL_WINDOW = 3600
+DENIALS = {}
+GATE_COUNTERS = Counter()
+
+async def auth_gate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Registered in group -1 so it runs before every other handler; stopping here means no
+    # handler ever sees an update from someone who is not allowed
+    user = update.effective_user
+    if user is not None and (user.id in ALLOWED_USERS or user.id == ADMIN_USER_ID):
+        GATE_COUNTERS['passed'] += 1
+        return
+
+    GATE_COUNTERS['dropped'] += 1
+    chat = update.effective_chat
+    if user is not None and chat is not None and chat.type == chat.PRIVATE:
+        now = time.monotonic()
+        if now - DENIALS.get(user.id, -DENIAL_WINDOW) >= DENIAL_WINDOW:
+            if len(DENIALS) > 10000:
+                for user_id, denied_at in list(DENIALS.items()):
+                    if now - denied_at >= DENIAL_WINDOW:
+                        del DENIALS[user_id]
+            DENIALS[user.id] = now
+            GATE_COUNTERS['denied'] += 1
+            try:
+                await context.bot.send_message(chat_id=chat.id, text="Sorry, you are not authorized to use this bot.")
+            except TelegramError as e:
+                logger.warning("Failed to send denial to %s: %s", user.id, e)
+    raise ApplicationHandlerStop
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    if user_id not in ALLOWED_USERS:
-        await update.message.reply_text("Sorry, you are not authorized to use this bot.")
-        return
-    USER_INTERACTIONS[user_id] = USER_INTERACTIONS.get(user_id, 0) + 1
+    STATS_STORE.count_interaction(user_id)
     await update.message.reply_text('Hello! Send me a music file.')
 
 async def add_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -49,10 +1466,8 @@ async def add_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 async def add_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         new_user_id = int(update.message.text)
-        if new_user_id not in ALLOWED_USERS:
-            ALLOWED_USERS[new_user_id] = datetime.now().strftime('%Y-%m-%d')
+        if USER_STORE.add(new_user_id):
             USER_INTERACTIONS[new_user_id] = 0
-            save_allowed_users()
             await update.message.reply_text(f"User {new_user_id} has been added.")
         else:
             await update.message.reply_text(f"User {new_user_id} is already allowed.")
@@ -71,10 +1486,8 @@ async def remove_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         user_id_to_remove = int(update.message.text)
-        if user_id_to_remove in ALLOWED_USERS:
-            del ALLOWED_USERS[user_id_to_remove]
-            USER_INTERACTIONS.pop(user_id_to_remove, None)
-            save_allowed_users()
+        if USER_STORE.remove(user_id_to_remove):
+            STATS_STORE.forget_user(user_id_to_remove)
             await update.message.reply_text(f"User {user_id_to_remove} has been removed.")
         else:
             await update.message.reply_text(f"User {user_id_to_remove} is not in the allowed users list.")
@@ -82,6 +1495,66 @@ async def remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         await update.message.reply_text("Please provide a valid user ID.")
     return ConversationHandler.END
 
+async def import_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You are not authorized to add users.")
+        return ConversationHandler.END
+
+    await update.message.reply_text("Please send a CSV or text file with one user ID per line "
+                                    "(only the first column is read).")
+    return IMPORT_USERS
+
+def parse_user_ids(lines):
+    # Reads one line at a time, so the file never has to be held in memory as a whole
+    user_ids = {}
+    duplicates = 0
+    invalid_lines = []
+    for number, line in enumerate(lines, 1):
+        field = re.split(r'[,;\s]+', line.strip(), maxsplit=1)[0]
+        if not field or (number == 1 and not re.search(r'[0-9]', field)):
+            # Blank line, or a header row such as the one /export_users writes
+            continue
+        # Not str.isdigit(), which also accepts digits like '²' or '١' that are no use as an id
+        if re.fullmatch(r'[0-9]+', field) and 0 < int(field) < MAX_USER_ID:
+            if int(field) in user_ids:
+                duplicates += 1
+            else:
+                user_ids[int(field)] = None
+        else:
+            invalid_lines.append(number)
+    return list(user_ids), duplicates, invalid_lines
+
+async def import_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    document_file = await update.message.document.get_file()
+    with tempfile.TemporaryFile() as buffer:
+        await document_file.download_to_memory(buffer)
+        buffer.seek(0)
+        user_ids, duplicates, invalid_lines = parse_user_ids(io.TextIOWrapper(buffer, encoding='utf-8-sig',
+                                                                              errors='replace'))
+
+    added = USER_STORE.add_many(user_ids)
+    for user_id in added:
+        USER_INTERACTIONS.setdefault(user_id, 0)
+
+    summary = (f"Import finished: {len(added)} added, {len(user_ids) - len(added)} already allowed, "
+               f"{duplicates} duplicate(s) in the file, {len(invalid_lines)} invalid line(s).")
+    if invalid_lines:
+        summary += "\nInvalid lines: " + ', '.join(map(str, invalid_lines[:20]))
+        if len(invalid_lines) > 20:
+            summary += ", ..."
+    await update.message.reply_text(summary)
+    return ConversationHandler.END
+
+async def export_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You are not authorized to view the user list.")
+        return
+
+    content = "user_id,date_added\n" + ''.join(f"{user_id},{date_added}\n"
+                                               for user_id, date_added in ALLOWED_USERS.items())
+    await update.message.reply_document(document=content.encode(), filename='allowed_users.csv',
+                                        caption=f"{len(ALLOWED_USERS)} allowed users")
+
 async def list_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id != ADMIN_USER_ID:
         await update.message.reply_text("You are not authorized to view the user list.")
@@ -91,22 +1564,27 @@ async def list_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await update.message.reply_text(f"Allowed users:\n{users_list}")
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if update.effective_user.id not in ALLOWED_USERS:
-        return
-    USER_INTERACTIONS[update.effective_user.id] += 1
+    STATS_STORE.count_interaction(update.effective_user.id)
     help_text = ("Use this bot to upload and categorize music files. Here's how you can use it:\n"
                  "/start - Begin interacting with the bot.\n"
                  "/help - Display this message.\n"
                  "/about - Learn about this bot.\n"
+                 "/search <words> - Find tracks that were shared before.\n"
                  "/add_user - Add a new user (admin only).\n"
                  "/remove_user - Remove an allowed user (admin only).\n"
                  "/list_users - List all allowed users (admin only).\n"
+                 "/import_users - Add users from a CSV/text file (admin only).\n"
+                 "/export_users - Download the allowed users as CSV (admin only).\n"
                  "/broadcast - Send a message to all users (admin only).\n"
-                 "/report - Generate a usage report (admin only).")
+                 "/broadcasts - List recent broadcasts (admin only).\n"
+                 "/pause_broadcast, /resume_broadcast, /cancel_broadcast [id] - Control a broadcast (admin only).\n"
+                 "/report - Generate a usage report (admin only).\n"
+                 "/health - Latency, error and queue summary (admin only).\n"
+                 "/stats [genres|users] [24h|7d|30d|today|week|month] - Upload statistics (admin only).")
     await update.message.reply_text(help_text)
 
 async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    USER_INTERACTIONS[update.effective_user.id] += 1
+    STATS_STORE.count_interaction(update.effective_user.id)
     about_text = ("Bot Information:\n"
                   "Version: 1.6\n"
                   "Owner: Mo Kashmiri\n"
@@ -130,15 +1608,153 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return ConversationHandler.END
 
     BROADCAST_HISTORY.append((datetime.now().strftime('%Y-%m-%d %H:%M:%S'), message))
-    for user_id in ALLOWED_USERS:
-        try:
-            await context.bot.send_message(chat_id=user_id, text=message)
-        except Exception as e:
-            print(f"Failed to send message to {user_id}: {e}")
+    # Broadcasts are rare, so write the history entry now rather than on the next timer flush
+    STATS_STORE.flush()
+    broadcast_id = BROADCASTS.create(message, update.effective_chat.id, list(ALLOWED_USERS))
+    # Run the broadcast in the background so this handler (and the admin's chat) is not blocked
+    start_broadcast_task(context.bot, broadcast_id)
 
-    await update.message.reply_text("Broadcast message sent.")
+    await update.message.reply_text(f"Broadcast #{broadcast_id} started, you will get a summary when it is done. "
+                                    f"Use /pause_broadcast, /resume_broadcast or /cancel_broadcast to control it.")
     return ConversationHandler.END
 
+async def broadcasts_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You are not authorized to view broadcasts.")
+        return
+
+    lines = []
+    for broadcast_id, message, _, created_at, status in BROADCASTS.recent():
+        counts = BROADCASTS.counts(broadcast_id)
+        preview = message if len(message) <= 30 else message[:30] + '...'
+        lines.append(f"#{broadcast_id} {created_at} [{status}] sent {counts['sent']}, failed {counts['failed']}, "
+                     f"pending {counts['pending']}: {preview}")
+    await update.message.reply_text("Recent broadcasts:\n" + '\n'.join(lines) if lines else "No broadcasts yet.")
+
+async def control_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str) -> None:
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You are not authorized to control broadcasts.")
+        return
+
+    if context.args:
+        try:
+            broadcast_id = int(context.args[0].lstrip('#'))
+        except ValueError:
+            await update.message.reply_text("Please provide a valid broadcast ID.")
+            return
+    else:
+        # Without an ID, act on the newest broadcast that is still running or paused
+        broadcast_id = max(BROADCASTS.statuses, default=None)
+    status = BROADCASTS.status(broadcast_id)
+    if status is None:
+        await update.message.reply_text("There is no running or paused broadcast with that ID.")
+        return
+
+    if action == 'pause':
+        if status == 'running':
+            BROADCASTS.set_status(broadcast_id, 'paused')
+        await update.message.reply_text(f"Broadcast #{broadcast_id} paused.")
+    elif action == 'resume':
+        if status == 'paused':
+            BROADCASTS.set_status(broadcast_id, 'running')
+        if broadcast_id not in BROADCASTS.tasks:
+            start_broadcast_task(context.bot, broadcast_id, resumed=True)
+        await update.message.reply_text(f"Broadcast #{broadcast_id} resumed.")
+    else:
+        BROADCASTS.set_status(broadcast_id, 'cancelled')
+        await update.message.reply_text(f"Broadcast #{broadcast_id} cancelled.")
+
+async def pause_broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await control_broadcast(update, context, 'pause')
+
+async def resume_broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await control_broadcast(update, context, 'resume')
+
+async def cancel_broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await control_broadcast(update, context, 'cancel')
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    STATS_STORE.count_interaction(update.effective_user.id)
+    query_text = ' '.join(context.args)
+    if not query_text:
+        await update.message.reply_text("Usage: /search <words from the performer, title or genre>")
+        return
+
+    results = CATALOG.search(query_text)
+    if not results:
+        await update.message.reply_text("No tracks found.")
+        return
+    # Tracks are sent again by file_id, Telegram serves them without a new upload
+    for file_id, performer, title, genre, sender_name, _ in results:
+        name = ' - '.join(part for part in (performer, title) if part)
+        await context.bot.send_audio(chat_id=update.effective_chat.id, audio=file_id,
+                                     caption=f"#{genre}\n{name}\nShared by: {sender_name}")
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.inline_query
+    # "#Chill sunset": hashtags pick the genre, the remaining words are searched
+    words = query.query.split()
+    genres = [word for word in words if word.startswith('#') and len(word) > 1]
+    text = ' '.join(word for word in words if not word.startswith('#'))
+    genre = genres[0] if genres else None
+    offset = int(query.offset) if re.fullmatch(r'[0-9]+', query.offset) else 0
+
+    cache_key = (text.lower(), genre.lower() if genre else None, offset)
+    results = INLINE_CACHE.get(cache_key)
+    if results is None:
+        if text or genre:
+            rows = CATALOG.search(text, genre, limit=INLINE_PAGE_SIZE, offset=offset)
+        else:
+            rows = CATALOG.recent(INLINE_PAGE_SIZE, offset)
+        results = [InlineQueryResultCachedAudio(id=str(catalog_id), audio_file_id=file_id,
+                                                caption=f"#{track_genre}\nShared by: {sender_name}")
+                   for file_id, _, _, track_genre, sender_name, catalog_id in rows]
+        INLINE_CACHE.put(cache_key, results)
+
+    next_offset = str(offset + INLINE_PAGE_SIZE) if len(results) == INLINE_PAGE_SIZE else ''
+    # Personal, so Telegram never serves these results from its cache to someone who is not allowed
+    await query.answer(results, cache_time=INLINE_CACHE_TTL, is_personal=True, next_offset=next_offset)
+
+def stats_window(argument):
+    # "24h", "7d", "today", "week" or "month"; returns (start timestamp, description)
+    now = datetime.now()
+    if argument == 'today':
+        return now.replace(hour=0, minute=0, second=0, microsecond=0).timestamp(), "today"
+    if argument == 'week':
+        start = now - timedelta(days=now.weekday())
+        return start.replace(hour=0, minute=0, second=0, microsecond=0).timestamp(), "this week"
+    if argument == 'month':
+        return now.replace(day=1, hour=0, minute=0, second=0, microsecond=0).timestamp(), "this month"
+    match = re.fullmatch(r'(\d+)([hd])', argument)
+    if not match:
+        return None, None
+    amount, unit = int(match.group(1)), match.group(2)
+    description = f"last {amount} {'hours' if unit == 'h' else 'days'}"
+    return time.time() - amount * (HOUR if unit == 'h' else DAY), description
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You are not authorized to view statistics.")
+        return
+
+    args = [arg.lower() for arg in context.args]
+    dimension = 'user' if args and args[0] in ('users', 'user', 'contributors') else 'genre'
+    if args and args[0] in ('users', 'user', 'contributors', 'genres', 'genre'):
+        args = args[1:]
+    since, description = stats_window(args[0] if args else '7d')
+    if since is None:
+        await update.message.reply_text("Usage: /stats [genres|users] [24h|7d|30d|today|week|month]")
+        return
+
+    rows = ANALYTICS.query(dimension, since, limit=10 if dimension == 'user' else None)
+    if not rows:
+        await update.message.reply_text(f"No uploads {description}.")
+        return
+    title = "Top contributors" if dimension == 'user' else "Uploads per genre"
+    lines = [f"{'User ' + key if dimension == 'user' else '#' + key}: {uploads} "
+             f"({duration // 3600}h {duration % 3600 // 60}m)" for key, uploads, duration in rows]
+    await update.message.reply_text(f"{title}, {description}:\n" + '\n'.join(lines))
+
 async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id != ADMIN_USER_ID:
         await update.message.reply_text("You are not authorized to generate a report.")
@@ -151,88 +1767,593 @@ async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     report_text += '\n'.join([f"User {user_id}: {count} interactions" for user_id, count in USER_INTERACTIONS.items()])
     report_text += "\n\nBroadcast History:\n"
     report_text += '\n'.join([f"{timestamp}: {message}" for timestamp, message in BROADCAST_HISTORY])
+    report_text += (f"\n\nUnauthorized updates dropped: {GATE_COUNTERS['dropped']} "
+                    f"(denials sent: {GATE_COUNTERS['denied']})")
+    report_text += "\n\nForwards by destination:\n"
+    report_text += '\n'.join([f"{chat_id}: " + ', '.join(f"{status} {count}" for status, count in sorted(statuses.items()))
+                               for chat_id, statuses in FORWARD_QUEUE.status_by_chat().items()])
+    report_text += f"\n\nBot API calls since start ({FLOW_MODE} flow): {sum(API_CALLS.values())}\n"
+    report_text += '\n'.join([f"{method}: {count}" for method, count in API_CALLS.most_common()])
 
     await update.message.reply_text(report_text)
 
-async def handle_music(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if update.effective_user.id not in ALLOWED_USERS:
-        await update.message.reply_text("Sorry, you are not authorized to use this bot.")
+async def health_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You are not authorized to view the bot health.")
         return
 
-    USER_INTERACTIONS[update.effective_user.id] += 1
-    context.user_data['music_file_id'] = update.message.message_id
-    await show_genres(update.message, context)
+    uptime = timedelta(seconds=int(time.time() - METRICS.started))
+    handled = sum(histogram.count for histogram in METRICS.handler_latency.values())
+    api_calls = sum(histogram.count for histogram in METRICS.api_latency.values())
+    health_text = f"Up {uptime}, {handled} updates handled, {sum(METRICS.handler_errors.values())} handler errors\n"
+    health_text += (f"Bot API: {api_calls} calls, {sum(METRICS.api_errors.values())} errors, "
+                    f"{sum(METRICS.api_retry_after.values())} flood waits\n")
+    health_text += "\nLatency p50 / p99:\n"
+    for name, histogram in sorted(list(METRICS.handler_latency.items()) + list(METRICS.step_latency.items()),
+                                  key=lambda item: -item[1].count):
+        health_text += f"{name}: {histogram.quantile(0.5) * 1000:.0f} / {histogram.quantile(0.99) * 1000:.0f} ms ({histogram.count})\n"
+    health_text += "\nQueues:\n"
+    health_text += '\n'.join(f"{name[len('telebot_'):]}: {value}"
+                             for name, value in METRICS.gauges(context.application).items())
 
-async def show_genres(message, context: ContextTypes.DEFAULT_TYPE) -> None:
-    genres = [
-        "#Chill", "#Latin", "#Dance", "#HipHop", "#HIGH_TEMPO",
-        "#FA_VINTAGE", "#EN_VINTAGE", "#Birthday", "#AfterParty",
-        "#Khaltoor", "#Arabic", "#Turki", "#Pop_Chosnale", "#Indian"
-    ]
+    await update.message.reply_text(health_text)
 
-    genre_buttons = [[InlineKeyboardButton(genre, callback_data=f'genre_{genre}')]
-                     for genre in genres]
+async def handle_music(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    STATS_STORE.count_interaction(update.effective_user.id)
+    incoming = context.user_data.setdefault('incoming', [])
+    audio = update.message.audio
+    keys = track_keys(audio)
+    duplicate = TRACK_INDEX.contains(keys)
+    if duplicate and DUPLICATE_POLICY == 'reject':
+        context.user_data['skipped'] = context.user_data.get('skipped', 0) + 1
+    else:
+        track = {'performer': audio.performer, 'title': audio.title, 'file_name': audio.file_name,
+                 'duration': audio.duration, 'file_id': audio.file_id, 'file_unique_id': audio.file_unique_id}
+        incoming.append([update.message.message_id, audio.file_id, keys, duplicate, track])
+
+    # Every new track pushes the batch deadline back, so an album arriving as separate updates ends up in one batch
+    name = f"batch_{update.effective_user.id}"
+    for job in context.job_queue.get_jobs_by_name(name):
+        job.schedule_removal()
+    when = 0 if len(incoming) >= BATCH_MAX_SIZE else BATCH_WINDOW
+    context.job_queue.run_once(close_batch, when, chat_id=update.effective_chat.id,
+                               user_id=update.effective_user.id, name=name)
+
+# Uploads waiting for a genre live in user_data['pending'], keyed by the id of the bot message that
+# carries their keyboard. A button press finds its upload through query.message, so any number of
+# uploads per user can be tagged at the same time and in any order.
+def pending_uploads(context: ContextTypes.DEFAULT_TYPE) -> dict:
+    return context.user_data.setdefault('pending', {})
+
+def keep_pending(context: ContextTypes.DEFAULT_TYPE, chat_id, message_id, upload: dict) -> None:
+    # Every step of the flow restarts the clock, so only uploads nobody touches for PENDING_TTL expire
+    upload['chat_id'] = chat_id
+    upload['expires_at'] = time.time() + PENDING_TTL
+    pending = pending_uploads(context)
+    if message_id not in pending:
+        METRICS.pending_uploads += 1
+    pending[message_id] = upload
+    # Oldest first: a user who keeps uploading without tagging pushes out their own oldest uploads
+    while len(pending) > PENDING_MAX_PER_USER:
+        old_message_id = next(iter(pending))
+        ORPHANED_KEYBOARDS.append((pending.pop(old_message_id)['chat_id'], old_message_id))
+        METRICS.pending_uploads -= 1
+
+async def expire_pending(context: ContextTypes.DEFAULT_TYPE) -> None:
+    application = context.application
+    now = time.time()
+    changed, emptied = [], []
+    for user_id, user_data in list(application.user_data.items()):
+        pending = user_data.get('pending', {})
+        expired = [message_id for message_id, upload in pending.items() if upload.get('expires_at', 0) <= now]
+        for message_id in expired:
+            ORPHANED_KEYBOARDS.append((pending.pop(message_id).get('chat_id', user_id), message_id))
+        METRICS.pending_uploads -= len(expired)
+        if 'pending' in user_data and not pending:
+            del user_data['pending']
+        if not user_data:
+            emptied.append(user_id)
+        elif expired:
+            changed.append(user_id)
+    # user_data of users with nothing in flight is dropped, so memory tracks active users only
+    for user_id in emptied:
+        application.drop_user_data(user_id)
+    if changed:
+        application.mark_data_for_update_persistence(user_ids=changed)
+    if ORPHANED_KEYBOARDS:
+        context.job_queue.run_once(close_orphaned_keyboards, 0)
+
+async def close_orphaned_keyboards(context: ContextTypes.DEFAULT_TYPE) -> None:
+    batch = ORPHANED_KEYBOARDS[:ORPHAN_CLEANUP_BATCH]
+    del ORPHANED_KEYBOARDS[:ORPHAN_CLEANUP_BATCH]
+    results = await asyncio.gather(*[
+        context.bot.edit_message_text("This upload has expired, please send the track again.",
+                                      chat_id=chat_id, message_id=message_id, rate_limit_args=PRIORITY_BULK)
+        for chat_id, message_id in batch], return_exceptions=True)
+    delay = 0
+    for keyboard, result in zip(batch, results):
+        if isinstance(result, RetryAfter):
+            ORPHANED_KEYBOARDS.append(keyboard)
+            delay = max(delay, retry_after_seconds(result))
+        elif isinstance(result, Exception) and not isinstance(result, TelegramError):
+            logger.error("Error closing expired keyboard %s", keyboard, exc_info=result)
+        # Other Telegram errors mean the message is gone or can't be edited; its buttons are refused anyway
+    if ORPHANED_KEYBOARDS:
+        context.job_queue.run_once(close_orphaned_keyboards, delay)
+
+@METRICS.timed('close_batch')
+async def close_batch(context: ContextTypes.DEFAULT_TYPE) -> None:
+    incoming = context.user_data.pop('incoming', [])
+    skipped = context.user_data.pop('skipped', 0)
+    if skipped:
+        await context.bot.send_message(chat_id=context.job.chat_id,
+                                       text=f"Skipped {skipped} track(s) that were already shared in the group.")
+    if not incoming:
+        return
+    upload = {
+        'message_ids': [entry[0] for entry in incoming],
+        'file_ids': [entry[1] for entry in incoming],
+        'track_keys': [entry[2] for entry in incoming],
+        'duplicates': sum(1 for entry in incoming if entry[3]),
+        'tracks': [entry[4] for entry in incoming],
+        'genre': None,
+    }
+    upload['suggested'] = GENRE_MODEL.suggest(upload['tracks'])
+    # Identifies the upload in the logs of every later step
+    upload['trace'] = f"{context.job.chat_id}:{upload['message_ids'][0]}"
+    CORRELATION.set({'user_id': context.job.user_id, 'chat_id': context.job.chat_id, 'upload': upload['trace']})
+    logger.info("Upload waiting for a genre", extra={'fields': {'tracks': len(upload['message_ids'])}})
+    await show_genres(context.job.chat_id, context, upload)
+
+def genre_prompt(upload: dict) -> str:
+    count = len(upload['message_ids'])
+    if count > 1:
+        text = f'Please choose the genre of these {count} tracks:'
+    else:
+        text = 'Please choose the genre of the music:'
+    if upload.get('duplicates'):
+        text = f"Note: {upload['duplicates']} of these track(s) were already shared in the group.\n" + text
+    return text
 
-    reply_markup = InlineKeyboardMarkup(genre_buttons)
-    sent_message = await message.reply_text('Please choose the genre of the music:', reply_markup=reply_markup)
-    context.user_data['last_message_id'] = sent_message.message_id
+def genre_markup(upload: dict, page=0) -> InlineKeyboardMarkup:
+    keyboard = GENRES.keyboard(page)
+    if not upload.get('suggested'):
+        return keyboard
+    # One tap on the suggestion forwards straight away; the cached page is reused underneath it
+    return InlineKeyboardMarkup(GENRES.suggestion_row(upload['suggested']) + list(keyboard.inline_keyboard))
+
+async def show_genres(chat_id, context: ContextTypes.DEFAULT_TYPE, upload: dict) -> None:
+    sent_message = await context.bot.send_message(chat_id=chat_id, text=genre_prompt(upload),
+                                                  reply_markup=genre_markup(upload),
+                                                  reply_to_message_id=upload['message_ids'][0])
+    keep_pending(context, chat_id, sent_message.message_id, upload)
 
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
-    await query.answer()
     data = query.data
 
-    if data.startswith('genre_'):
-        context.user_data['selected_genre'] = data
-        await query.message.delete()
-        await confirm_forward(update, context)
-    elif data == 'confirm_forward':
-        await forward_music(update, context)
-    elif data == 'choose_again':
-        await show_genres(update.callback_query.message, context)
+    upload = pending_uploads(context).pop(query.message.message_id, None)
+    if upload is None:
+        await query.answer("This upload is no longer pending, please send the track again.")
+        return
+    METRICS.pending_uploads -= 1
+    CORRELATION.set({**CORRELATION.get(), 'upload': upload.get('trace')})
+    if upload.get('expires_at', math.inf) <= time.time():
+        # Expired but not swept yet
+        await query.answer()
+        await query.edit_message_text("This upload has expired, please send the track again.")
+        return
+    try:
+        await query.answer()
+
+        if data.startswith('p:'):
+            _, _, page = data.split(':')
+            await query.edit_message_reply_markup(genre_markup(upload, int(page)))
+            keep_pending(context, query.message.chat_id, query.message.message_id, upload)
+        elif data.startswith(('g:', 's:', 'genre_')):
+            if data.startswith(('g:', 's:')):
+                _, version, index = data.split(':')
+                genre = GENRES.resolve(version, int(index))
+            else:
+                # Keyboards sent before genres became configurable
+                genre = data[len('genre_'):]
+            if genre is None:
+                await query.edit_message_text("The genre list has changed, please choose again:",
+                                              reply_markup=genre_markup(upload))
+                keep_pending(context, query.message.chat_id, query.message.message_id, upload)
+                return
+            upload['genre'] = genre.lstrip('#')
+            logger.info("Genre chosen", extra={'fields': {'genre': upload['genre'], 'suggested': data.startswith('s:')}})
+            if data.startswith('s:'):
+                await forward_music(update, context, upload)
+                return
+            if FLOW_MODE == 'classic':
+                await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id,
+                                                 rate_limit_args=PRIORITY_BULK)
+            await confirm_forward(update, context, upload)
+        elif data == 'confirm_forward':
+            await forward_music(update, context, upload)
+        elif data == 'choose_again':
+            if FLOW_MODE == 'classic':
+                await show_genres(update.effective_chat.id, context, upload)
+            else:
+                await query.edit_message_text(genre_prompt(upload), reply_markup=genre_markup(upload))
+                keep_pending(context, query.message.chat_id, query.message.message_id, upload)
+    except Exception:
+        # A timed out or failed API call must not lose the upload: unless a step already kept it
+        # under its next message, it goes back where it was so the button can be pressed again
+        if not any(pending is upload for pending in pending_uploads(context).values()):
+            keep_pending(context, query.message.chat_id, query.message.message_id, upload)
+        raise
 
-async def confirm_forward(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def confirm_forward(update: Update, context: ContextTypes.DEFAULT_TYPE, upload: dict) -> None:
     keyboard = [
         [InlineKeyboardButton("Yes, forward it", callback_data='confirm_forward')],
         [InlineKeyboardButton("Choose again", callback_data='choose_again')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.callback_query.message.reply_text("Confirm to forward with this genre?", reply_markup=reply_markup)
+    count = len(upload['message_ids'])
+    text = f"Confirm to forward these {count} tracks with this genre?" if count > 1 else "Confirm to forward with this genre?"
+    query = update.callback_query
+    if FLOW_MODE == 'classic':
+        sent_message = await query.message.reply_text(text, reply_markup=reply_markup)
+    else:
+        sent_message = await query.edit_message_text(text, reply_markup=reply_markup)
+    keep_pending(context, sent_message.chat_id, sent_message.message_id, upload)
 
-async def forward_music(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+@METRICS.timed('forward_music')
+async def forward_music(update: Update, context: ContextTypes.DEFAULT_TYPE, upload: dict) -> None:
     query = update.callback_query
 
-    music_file_id = context.user_data.get('music_file_id')
-    selected_genre = context.user_data.get('selected_genre')
-    genre_name = selected_genre.replace('genre_#', '')
+    message_ids = upload['message_ids']
+    file_ids = upload['file_ids']
+    genre_name = upload['genre']
 
     user = update.effective_user
     sender_name = user.full_name
 
     caption = f"#{genre_name}\nSender: {sender_name}"
 
-    await context.bot.copy_message(chat_id=GROUP_CHAT_ID,
-                                   from_chat_id=update.effective_chat.id,
-                                   message_id=music_file_id,
-                                   caption=caption)
+    # The copy is spooled and sent by forward_worker(), so the button press is acknowledged right away.
+    # The key makes a double tap on "Yes, forward it" a no-op instead of a second copy in the group.
+    # Batches go out as albums of up to MEDIA_GROUP_SIZE tracks per API call.
+    # Every destination of the genre gets its own job, so the workers send to them in parallel and
+    # one chat failing or being rate limited does not hold back or fail the others.
+    chat_id = update.effective_chat.id
+    targets = ROUTES.targets(genre_name)
+    if not targets:
+        # Never thank the user for tracks that go nowhere; the upload stays pending for another genre
+        logger.error("No destination chat for genre %s", genre_name)
+        await query.edit_message_text("Tracks of this genre can't be forwarded right now, please choose another genre:",
+                                      reply_markup=genre_markup(upload))
+        keep_pending(context, query.message.chat_id, query.message.message_id, upload)
+        return
+    tracks = upload.get('tracks', [])
+    for start in range(0, len(message_ids), MEDIA_GROUP_SIZE):
+        chunk = message_ids[start:start + MEDIA_GROUP_SIZE]
+        chunk_file_ids = file_ids[start:start + MEDIA_GROUP_SIZE] if len(chunk) > 1 else None
+        tags = None
+        if RETAG_MODE and tracks:
+            tags = {'genre': genre_name, 'sender': sender_name,
+                    'files': [[track['file_id'], track.get('file_name')] for track in tracks[start:start + MEDIA_GROUP_SIZE]]}
+        # Recorded by the worker once the tracks reach their first destination, not when they are
+        # queued, so tracks whose forward fails are not counted, searchable or rejected as duplicates
+        upload_key = f"{chat_id}:{','.join(map(str, chunk))}"
+        delivery = {'user_id': user.id, 'sender_name': sender_name, 'genre': genre_name,
+                    'tracks': tracks[start:start + MEDIA_GROUP_SIZE],
+                    'track_keys': upload.get('track_keys', [])[start:start + MEDIA_GROUP_SIZE]}
+        for target in targets:
+            FORWARD_QUEUE.enqueue(f"{upload_key}:{target}", target, chat_id, chunk[0], caption, chunk_file_ids, tags,
+                                  upload_key, delivery)
+    logger.info("Upload queued for forwarding", extra={'fields': {
+        'genre': genre_name, 'targets': targets, 'message_ids': message_ids, 'retag': RETAG_MODE}})
+
+    thank_you_text = "Thank you for reaching out, catch you later and have a nice day!"
+    if FLOW_MODE != 'classic':
+        await query.edit_message_text(thank_you_text)
+        return
+
+    try:
+        await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id,
+                                         rate_limit_args=PRIORITY_BULK)
+    except Exception as e:
+        logger.warning("Error deleting confirmation message: %s", e)
+
+    await context.bot.send_message(chat_id=chat_id, text=thank_you_text)
 
+def record_delivery(delivery: dict) -> None:
+    tracks, genre_name, user_id = delivery['tracks'], delivery['genre'], delivery['user_id']
+    TRACK_INDEX.remember([key for keys in delivery['track_keys'] for key in keys])
+    GENRE_MODEL.learn(tracks, genre_name)
+    for track in tracks:
+        ANALYTICS.record(user_id, genre_name, track.get('duration'))
+    CATALOG.add(tracks, genre_name, user_id, delivery['sender_name'])
+
+def retag_file(path, genre, sender) -> None:
+    # Runs in RETAG_POOL; mutagen picks the tag format (ID3, MP4 atoms, Vorbis comments) from the file
+    audio = mutagen.File(path)
+    if audio is None:
+        raise ValueError("unsupported audio format")
+    if audio.tags is None:
+        audio.add_tags()
+    comment = f"#{genre} shared by {sender}"
+    if isinstance(audio.tags, ID3):
+        audio.tags.setall('TCON', [TCON(encoding=3, text=[genre])])
+        audio.tags.setall('COMM', [COMM(encoding=3, lang='eng', desc='', text=[comment])])
+        audio.tags.setall('TXXX:SENDER', [TXXX(encoding=3, desc='SENDER', text=[sender])])
+    elif isinstance(audio.tags, MP4Tags):
+        audio.tags['\xa9gen'] = [genre]
+        audio.tags['\xa9cmt'] = [comment]
+        audio.tags['----:com.apple.iTunes:SENDER'] = [MP4FreeForm(sender.encode())]
+    else:
+        audio.tags['GENRE'] = [genre]
+        audio.tags['COMMENT'] = [comment]
+        audio.tags['SENDER'] = [sender]
+    audio.save()
+
+def read_file(path) -> bytes:
+    with open(path, 'rb') as file:
+        return file.read()
+
+async def download_track(bot, file_id, path) -> None:
+    # Streamed to disk chunk by chunk; download_to_drive() would hold the whole file in memory first.
+    # Disk writes go through the default executor so a slow disk never blocks the event loop.
+    loop = asyncio.get_running_loop()
+    file = await bot.get_file(file_id, rate_limit_args=PRIORITY_FORWARD)
+    async with httpx.AsyncClient(timeout=RETAG_DOWNLOAD_TIMEOUT) as client:
+        async with client.stream('GET', file.file_path) as response:
+            response.raise_for_status()
+            out = await loop.run_in_executor(None, open, path, 'wb')
+            try:
+                async for chunk in response.aiter_bytes(RETAG_CHUNK_SIZE):
+                    await loop.run_in_executor(None, out.write, chunk)
+            finally:
+                await loop.run_in_executor(None, out.close)
+
+@METRICS.timed('retag')
+async def send_retagged(bot, chat_id, caption, tags) -> None:
+    loop = asyncio.get_running_loop()
+    directory = await loop.run_in_executor(None, functools.partial(tempfile.mkdtemp, prefix='retag-'))
     try:
-        await query.message.delete()
+        # Each entry is the retagged file's bytes, or the original file id if retagging did not work
+        files = []
+        for index, (file_id, file_name) in enumerate(tags['files']):
+            safe_name = re.sub(r'[^\w.-]', '_', file_name or 'track.mp3')
+            path = os.path.join(directory, f"{index}-{safe_name}")
+            try:
+                if mutagen is None:
+                    raise RuntimeError("mutagen is not installed")
+                await download_track(bot, file_id, path)
+                await loop.run_in_executor(RETAG_POOL, retag_file, path, tags['genre'], tags['sender'])
+                files.append(await loop.run_in_executor(None, read_file, path))
+            except RetryAfter:
+                # A flood wait is not the track's fault; the whole job is retried later
+                raise
+            except Exception as e:
+                # Too big to download (the Bot API serves up to 20 MB), a file mutagen can't parse,
+                # a broken process pool: the track goes out as it is
+                logger.warning("Sending %s untagged: %r", file_name or file_id, e)
+                files.append(file_id)
+
+        if len(files) == 1:
+            await bot.send_audio(chat_id=chat_id, audio=files[0], caption=caption,
+                                 filename=tags['files'][0][1], rate_limit_args=PRIORITY_FORWARD)
+        else:
+            await bot.send_media_group(chat_id=chat_id,
+                                       media=[InputMediaAudio(file, caption=caption, filename=file_name)
+                                              for file, (_, file_name) in zip(files, tags['files'])],
+                                       rate_limit_args=PRIORITY_FORWARD)
+    finally:
+        await loop.run_in_executor(None, functools.partial(shutil.rmtree, directory, ignore_errors=True))
+
+async def forward_worker(bot, queue: ForwardQueue) -> None:
+    # on_stop() sets queue.stopping and lets a job that is already being sent finish, so it is not
+    # handed out again, and posted twice, after the restart
+    while not queue.stopping:
+        try:
+            job = queue.claim()
+            if job is None:
+                queue.wakeup.clear()
+                try:
+                    await asyncio.wait_for(queue.wakeup.wait(), timeout=queue.next_due_in())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await send_forward(bot, queue, job)
+        except Exception:
+            # e.g. the database is locked; the worker must outlive it or forwarding stops for good
+            logger.exception("Forward worker error")
+            await asyncio.sleep(FORWARD_POLL_INTERVAL)
+
+async def send_forward(bot, queue: ForwardQueue, job) -> None:
+    job_id, chat_id, from_chat_id, message_id, caption, file_ids, tags, attempts = job
+    CORRELATION.set({'job': job_id, 'chat_id': chat_id, 'source': f"{from_chat_id}:{message_id}"})
+    started = time.perf_counter()
+    try:
+        if tags:
+            await send_retagged(bot, chat_id, caption, json.loads(tags))
+        elif file_ids:
+            await bot.send_media_group(chat_id=chat_id, media=[InputMediaAudio(file_id, caption=caption)
+                                                               for file_id in json.loads(file_ids)],
+                                       rate_limit_args=PRIORITY_FORWARD)
+        else:
+            await bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id,
+                                   caption=caption, rate_limit_args=PRIORITY_FORWARD)
+    except asyncio.CancelledError:
+        # on_stop() gave up waiting, e.g. on a long flood wait or a retag download; the job goes back
+        # to the spool for the next start instead of staying claimed
+        queue.retry(job_id, 0, 'cancelled on stop', count_attempt=False)
+        raise
+    except RetryAfter as e:
+        # Flood waits are not the job's fault and do not count against its attempts
+        queue.retry(job_id, retry_after_seconds(e), e, count_attempt=False)
+    except (Forbidden, BadRequest) as e:
+        # The source message is gone or the bot lost access to the group
+        logger.error("Forward %s to %s failed permanently: %s", job_id, chat_id, e)
+        queue.fail(job_id, e)
     except Exception as e:
-        print(f"Error deleting confirmation message: {e}")
+        if not isinstance(e, (TelegramError, httpx.HTTPError)):
+            logger.exception("Forward %s to %s failed unexpectedly", job_id, chat_id)
+        if attempts + 1 >= FORWARD_MAX_ATTEMPTS:
+            logger.error("Forward %s to %s failed after %s attempts: %s", job_id, chat_id, attempts + 1, e)
+            queue.fail(job_id, e)
+        else:
+            queue.retry(job_id, min(FORWARD_MAX_BACKOFF, 2 ** (attempts + 1)), e)
+    else:
+        delivery = queue.complete(job_id)
+        logger.info("Forwarded", extra={'fields': {'attempt': attempts + 1}})
+        if delivery:
+            record_delivery(delivery)
+    finally:
+        METRICS.step_latency['forward_job'].observe(time.perf_counter() - started)
 
-    thank_you_text = "Thank you for reaching out, catch you later and have a nice day!"
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=thank_you_text)
+async def on_startup(application: Application) -> None:
+    global RETAG_POOL
+    if RETAG_MODE:
+        RETAG_POOL = ProcessPoolExecutor(RETAG_PROCESSES)
+    FORWARD_QUEUE.wakeup = asyncio.Event()
+    FORWARD_QUEUE.stopping = False
+    FORWARD_QUEUE.release_claimed()
+    if METRICS_PORT and web is not None:
+        metrics_app = web.Application()
+        metrics_app['application'] = application
+        metrics_app.router.add_get('/metrics', metrics_handler)
+        runner = web.AppRunner(metrics_app, access_log=None)
+        await runner.setup()
+        METRICS_RUNNERS.append(runner)
+        try:
+            await web.TCPSite(runner, METRICS_LISTEN, METRICS_PORT).start()
+        except OSError as e:
+            # e.g. a second instance on the same host; the bot itself keeps running
+            logger.warning("Metrics endpoint disabled: %s", e)
+    elif METRICS_PORT:
+        logger.warning("Metrics endpoint disabled: pip install aiohttp")
+    # Tracks that were still being collected into a batch when the bot went down get their genre prompt now
+    METRICS.pending_uploads = 0
+    for user_id, user_data in application.user_data.items():
+        METRICS.pending_uploads += len(user_data.get('pending', {}))
+        if user_data.get('incoming') or user_data.get('skipped'):
+            application.job_queue.run_once(close_batch, 0, chat_id=user_id, user_id=user_id, name=f"batch_{user_id}")
+    for _ in range(FORWARD_WORKERS):
+        FORWARD_WORKER_TASKS.append(asyncio.create_task(forward_worker(application.bot, FORWARD_QUEUE)))
+    # Broadcasts interrupted by a crash or restart carry on where they stopped
+    BROADCASTS.stopping = False
+    for broadcast_id, status in list(BROADCASTS.statuses.items()):
+        if status == 'running' and broadcast_id not in BROADCASTS.tasks:
+            start_broadcast_task(application.bot, broadcast_id, resumed=True)
+
+async def on_stop(application: Application) -> None:
+    for runner in METRICS_RUNNERS:
+        await runner.cleanup()
+    METRICS_RUNNERS.clear()
+
+    # Let forward and broadcast workers finish the message they are sending, so nothing goes out
+    # twice after a restart; idle forward workers are woken up to notice
+    FORWARD_QUEUE.stopping = True
+    FORWARD_QUEUE.wakeup.set()
+    BROADCASTS.stopping = True
+    tasks = FORWARD_WORKER_TASKS + list(BROADCASTS.tasks.values())
+    if tasks:
+        _, still_running = await asyncio.wait(tasks, timeout=max(FORWARD_STOP_TIMEOUT, BROADCAST_STOP_TIMEOUT))
+        for task in still_running:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    FORWARD_WORKER_TASKS.clear()
+    if RETAG_POOL:
+        RETAG_POOL.shutdown(cancel_futures=True)
+
+async def flush_stats(context: ContextTypes.DEFAULT_TYPE) -> None:
+    STATS_STORE.flush()
+    ANALYTICS.flush()
+    FORWARD_QUEUE.purge_done()
+
+async def on_shutdown(application: Application) -> None:
+    STATS_STORE.flush()
+    ANALYTICS.flush()
+
+async def webhook_handler(request) -> 'web.Response':
+    application = request.app['application']
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        return web.Response(status=403)
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    if not isinstance(data, dict):
+        # Valid JSON but not an Update, e.g. [1]
+        return web.Response(status=400)
+    try:
+        update = Update.de_json(data, application.bot)
+    except (TypeError, KeyError, ValueError):
+        # An object without update_id, or fields of the wrong type
+        return web.Response(status=400)
+    # Hand the update to the Application's own queue and answer Telegram right away
+    await application.update_queue.put(update)
+    return web.Response()
+
+async def run_webhook(application: Application) -> None:
+    web_app = web.Application()
+    web_app['application'] = application
+    web_app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    runner = web.AppRunner(web_app)
+
+    # Same lifecycle as run_polling(): SIGINT/SIGTERM stop the bot, post_stop runs after stop() and
+    # post_shutdown after shutdown(), whether startup got all the way through or not
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(stop_signal, stop_event.set)
+    try:
+        async with application:
+            try:
+                if application.post_init:
+                    await application.post_init(application)
+                await application.start()
+                await runner.setup()
+                await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+                if WEBHOOK_REGISTER:
+                    await application.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+                await stop_event.wait()
+            finally:
+                await runner.cleanup()
+                if application.running:
+                    await application.stop()
+                if application.post_stop:
+                    await application.post_stop(application)
+    finally:
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def check_config() -> None:
+    # Settings no restart can fix; checked before the supervisor loop so they fail once instead of every 10s
+    if RETAG_MODE and mutagen is None:
+        raise RuntimeError("Retag mode needs mutagen: pip install mutagen")
+    if BOT_MODE == 'webhook':
+        if web is None:
+            raise RuntimeError("Webhook mode needs aiohttp: pip install aiohttp")
+        if not WEBHOOK_SECRET:
+            raise RuntimeError("Webhook mode needs WEBHOOK_SECRET to be set")
+        if WEBHOOK_REGISTER and not WEBHOOK_URL:
+            raise RuntimeError("Webhook mode needs WEBHOOK_URL to be set, or WEBHOOK_REGISTER=0")
 
 def main() -> None:
-    application = Application.builder().token(BOT_TOKEN).build()
+    check_config()
+    application = (Application.builder().token(BOT_TOKEN).base_url(BOT_API_URL).base_file_url(BOT_API_FILE_URL)
+                   .request(CountingRequest()).rate_limiter(ApiScheduler())
+                   .persistence(SQLitePersistence(DB))
+                   .post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown).build())
+    application.job_queue.run_repeating(flush_stats, interval=STATS_FLUSH_INTERVAL, first=STATS_FLUSH_INTERVAL)
+    application.job_queue.run_repeating(expire_pending, interval=PENDING_SWEEP_INTERVAL, first=PENDING_SWEEP_INTERVAL)
 
     add_user_handler = ConversationHandler(
         entry_points=[CommandHandler('add_user', add_user_command)],
         states={
             ADD_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_user)],
         },
-        fallbacks=[]
+        fallbacks=[],
+        name='add_user',
+        persistent=True
     )
 
     remove_user_handler = ConversationHandler(
@@ -240,7 +2361,9 @@ def main() -> None:
         states={
             REMOVE_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, remove_user)],
         },
-        fallbacks=[]
+        fallbacks=[],
+        name='remove_user',
+        persistent=True
     )
 
     broadcast_handler = ConversationHandler(
@@ -248,28 +2371,62 @@ def main() -> None:
         states={
             BROADCAST: [MessageHandler(filters.TEXT & ~filters.COMMAND, broadcast)],
         },
-        fallbacks=[]
+        fallbacks=[],
+        name='broadcast',
+        persistent=True
+    )
+
+    import_users_handler = ConversationHandler(
+        entry_points=[CommandHandler('import_users', import_users_command)],
+        states={
+            IMPORT_USERS: [MessageHandler(filters.Document.ALL, import_users)],
+        },
+        fallbacks=[],
+        name='import_users',
+        persistent=True
     )
 
     # Register handlers
+    application.add_handler(TypeHandler(Update, correlate), group=-2)
+    application.add_handler(TypeHandler(Update, auth_gate), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("about", about_command))
     application.add_handler(CommandHandler("list_users", list_users_command))
     application.add_handler(CommandHandler("report", report_command))
+    application.add_handler(CommandHandler("health", health_command))
+    application.add_handler(CommandHandler("export_users", export_users_command))
+    application.add_handler(CommandHandler("broadcasts", broadcasts_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("search", search_command))
+    application.add_handler(InlineQueryHandler(inline_query))
+    application.add_handler(CommandHandler("pause_broadcast", pause_broadcast_command))
+    application.add_handler(CommandHandler("resume_broadcast", resume_broadcast_command))
+    application.add_handler(CommandHandler("cancel_broadcast", cancel_broadcast_command))
     application.add_handler(add_user_handler)
     application.add_handler(remove_user_handler)
     application.add_handler(broadcast_handler)
+    application.add_handler(import_users_handler)
     application.add_handler(MessageHandler(filters.AUDIO, handle_music))
     application.add_handler(CallbackQueryHandler(button))
+    trace_handlers(application.handlers[0])
 
-    application.run_polling()
+    if BOT_MODE == 'webhook':
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
-    while True:
-        try:
-            main()
-        except Exception as e:
-            print(f"Error occurred: {e}")
-            print("Bot restarting in 10 seconds...")
-            time.sleep(10)
+    log_listener = setup_logging()
+    try:
+        check_config()
+        while True:
+            try:
+                main()
+                # A clean return means SIGINT/SIGTERM asked the bot to stop
+                break
+            except Exception:
+                logger.exception("Bot crashed, restarting in 10 seconds")
+                time.sleep(10)
+    finally:
+        log_listener.stop()
@@ -0,0 +1,131 @@
+import asyncio
+import itertools
+import json
+import random
+import time
+
+from aiohttp import web
+
+# Methods whose answer is a Message; everything not listed here answers True
+MESSAGE_METHODS = ('sendMessage', 'sendAudio', 'sendDocument', 'copyMessage', 'editMessageText',
+                   'editMessageReplyMarkup')
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot',
+            'can_join_groups': True, 'can_read_all_group_messages': False, 'supports_inline_queries': True}
+
+class FakeBotAPI:
+    # Stand-in for api.telegram.org good enough to run the bot's main() against. Updates pushed with
+    # push_update() are served to getUpdates; every other call is recorded in `calls` and can be
+    # awaited with expect(). `latency` delays each answer and `rate_429` is the share of sending
+    # calls answered with a flood wait of `retry_after` seconds.
+    def __init__(self, latency=0.0, rate_429=0.0, retry_after=1):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1000)
+        self.new_updates = asyncio.Event()
+        self.calls = []
+        self.injected_429 = 0
+        self.waiters = []
+        self.files = {}
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        app.router.add_get('/file/bot{token}/{path:.*}', self.download)
+        return app
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.runner = web.AppRunner(self.app(), access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        self.port = self.runner.addresses[0][1]
+        self.base_url = f'http://{host}:{self.port}/bot'
+        self.base_file_url = f'http://{host}:{self.port}/file/bot'
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def push_update(self, update) -> dict:
+        update['update_id'] = next(self.update_ids)
+        self.updates.append(update)
+        self.new_updates.set()
+        return update
+
+    def message(self, chat_id, **fields) -> dict:
+        return {'message_id': next(self.message_ids), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'}, **fields}
+
+    def expect(self, predicate) -> asyncio.Future:
+        # Resolves with (data, result) of the first later call for which predicate(method, data) is
+        # true. Register before pushing the update that triggers the call, the bot may answer first.
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((predicate, future))
+        return future
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        if request.content_type == 'application/json':
+            data = await request.json()
+        else:
+            data = {key: value if isinstance(value, str) else value.file.read()
+                    for key, value in (await request.post()).items()}
+        for key in ('reply_markup', 'media'):
+            if isinstance(data.get(key), str):
+                data[key] = json.loads(data[key])
+
+        if method == 'getUpdates':
+            return web.json_response({'ok': True, 'result': await self.get_updates(data)})
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method.startswith(('send', 'copy')) and random.random() < self.rate_429:
+            self.injected_429 += 1
+            return web.json_response({'ok': False, 'error_code': 429,
+                                      'description': f'Too Many Requests: retry after {self.retry_after}',
+                                      'parameters': {'retry_after': self.retry_after}}, status=429)
+
+        result = self.result(method, data)
+        self.calls.append((time.perf_counter(), method, data))
+        for predicate, future in self.waiters:
+            if not future.done() and predicate(method, data):
+                future.set_result((data, result))
+        self.waiters = [waiter for waiter in self.waiters if not waiter[1].done()]
+        return web.json_response({'ok': True, 'result': result})
+
+    async def get_updates(self, data):
+        # Like Telegram, updates are only dropped once a later call confirms them with its offset, so a
+        # long poll left behind by a bot that restarted cannot swallow updates meant for the new one
+        offset = int(data.get('offset') or 0)
+        self.updates = [update for update in self.updates if update['update_id'] >= offset]
+        timeout = float(data.get('timeout') or 0)
+        if not self.updates and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(self.updates)
+
+    def result(self, method, data):
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getFile':
+            return {'file_id': data['file_id'], 'file_unique_id': data['file_id'],
+                    'file_path': f"music/{data['file_id']}"}
+        if method == 'sendMediaGroup':
+            return [self.message(int(data['chat_id']), audio={'file_id': 'album', 'file_unique_id': 'album',
+                                                              'duration': 0})
+                    for _ in data['media']]
+        if method in MESSAGE_METHODS:
+            message = self.message(int(data['chat_id']), text=data.get('text', ''), **{'from': BOT_USER})
+            if method.startswith('edit'):
+                message['message_id'] = int(data['message_id'])
+            if method == 'copyMessage':
+                return {'message_id': message['message_id']}
+            return message
+        return True
+
+    async def download(self, request):
+        return web.Response(body=self.files.get(request.match_info['path'].rsplit('/', 1)[-1], b''))
@@ -0,0 +1,359 @@
+"""Drives the bot's main() against FakeBotAPI and reports throughput and latency.
+
+    python benchmarks/load_test.py --users 50 --uploads 2 --tracks 3 --latency 0.02 --rate-429 0.01
+    python benchmarks/load_test.py --users 300 --uploads 0 --control --probes 5 --rate-429 0.01
+"""
+import argparse
+import asyncio
+import importlib.util
+import itertools
+import math
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import zlib
+from collections import Counter, defaultdict
+
+from fake_bot_api import FakeBotAPI
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Telegram Music Bot', 'telebot v1.7.py')
+FIRST_USER_ID = 100000
+# Calls made once at startup and shutdown, not by any upload
+LIFECYCLE_METHODS = ('getMe', 'deleteWebhook', 'setWebhook')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20, help="simulated users uploading at the same time")
+    parser.add_argument('--uploads', type=int, default=2, help="upload sessions per user, one after the other")
+    parser.add_argument('--tracks', type=int, default=1, help="audio files per upload")
+    parser.add_argument('--broadcasts', type=int, default=1, help="broadcasts to all users after the uploads")
+    parser.add_argument('--control', action='store_true',
+                        help="pause, resume, stop and restart the bot during each broadcast, then cancel one more")
+    parser.add_argument('--probes', type=int, default=0,
+                        help="users sending /start over and over while a broadcast is running")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds the fake API takes to answer")
+    parser.add_argument('--rate-429', type=float, default=0.0, help="share of sends answered with a flood wait")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after of injected flood waits")
+    parser.add_argument('--batch-window', type=float, default=0.2,
+                        help="override BATCH_WINDOW so prompts don't wait the production 2s")
+    parser.add_argument('--group-interval', type=float, default=0.0,
+                        help="override GROUP_CHAT_INTERVAL; 0 measures the bot rather than Telegram's group limit")
+    parser.add_argument('--api-rate', type=float, help="override API_RATE (default: the bot's own)")
+    parser.add_argument('--timeout', type=float, default=120, help="seconds to wait for any single step")
+    return parser.parse_args()
+
+def load_bot(api, args):
+    state_dir = tempfile.mkdtemp(prefix='telebot-bench-')
+    # Read at import time, so they have to be set before the module is executed
+    os.environ.update({
+        'BOT_TOKEN': '1:bench',
+        'BOT_API_URL': api.base_url,
+        'BOT_API_FILE_URL': api.base_file_url,
+        'DB_PATH': os.path.join(state_dir, 'bench.db'),
+        'ROUTES_FILE': os.path.join(state_dir, 'routes.json'),
+        'METRICS_PORT': '0',
+        'FLOW_MODE': 'edit',
+    })
+    spec = importlib.util.spec_from_file_location('telebot', BOT_PATH)
+    bot = importlib.util.module_from_spec(spec)
+    # Registered so the retag process pool can pickle the module's functions
+    sys.modules['telebot'] = bot
+    spec.loader.exec_module(bot)
+    bot.BATCH_WINDOW = args.batch_window
+    bot.GROUP_CHAT_INTERVAL = args.group_interval
+    if args.api_rate:
+        bot.API_RATE = args.api_rate
+    bot.USER_STORE.add_many(range(FIRST_USER_ID, FIRST_USER_ID + args.users))
+    return bot
+
+def percentile(values, q) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, math.ceil(q * len(values)) - 1)]
+
+def callbacks(data) -> list:
+    markup = data.get('reply_markup') or {}
+    return [button.get('callback_data', '') for row in markup.get('inline_keyboard', []) for button in row]
+
+class LoadGenerator:
+    def __init__(self, api, bot, args):
+        self.api = api
+        self.bot = bot
+        self.args = args
+        self.callback_ids = itertools.count(1)
+        self.step_latency = defaultdict(list)
+        self.updates_sent = 0
+        self.control = defaultdict(list)
+        # Set before a SIGINT that main() should answer by starting the bot again
+        self.restart = threading.Event()
+        self.restarting = False
+
+    def user(self, user_id) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+    def send_text(self, user_id, text):
+        self.updates_sent += 1
+        message = self.api.message(user_id, text=text, **{'from': self.user(user_id)})
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        self.api.push_update({'message': message})
+
+    def send_audio(self, user_id, track):
+        self.updates_sent += 1
+        seed = zlib.crc32(track.encode())
+        audio = {'file_id': f'file-{track}', 'file_unique_id': f'unique-{track}', 'duration': 120 + seed % 240,
+                 'title': f'Track {track}', 'performer': f'Artist {seed % 50}', 'file_name': f'{track}.mp3'}
+        self.api.push_update({'message': self.api.message(user_id, audio=audio, **{'from': self.user(user_id)})})
+
+    def click(self, user_id, message_id, data):
+        self.updates_sent += 1
+        message = self.api.message(user_id, text='', **{'from': {'id': 1, 'is_bot': True, 'first_name': 'Bench'}})
+        message['message_id'] = message_id
+        self.api.push_update({'callback_query': {'id': str(next(self.callback_ids)), 'from': self.user(user_id),
+                                                 'chat_instance': str(user_id), 'data': data, 'message': message}})
+
+    async def step(self, name, future, trigger):
+        started = time.perf_counter()
+        trigger()
+        result = await asyncio.wait_for(future, self.args.timeout)
+        self.step_latency[name].append(time.perf_counter() - started)
+        return result
+
+    async def upload_session(self, user_id, session):
+        api = self.api
+        prompt = api.expect(lambda method, data: method == 'sendMessage' and int(data['chat_id']) == user_id
+                            and any(callback.startswith('g:') for callback in callbacks(data)))
+        tracks = [f'{user_id}-{session}-{index}' for index in range(self.args.tracks)]
+        data, message = await self.step('upload -> genre prompt', prompt,
+                                        lambda: [self.send_audio(user_id, track) for track in tracks])
+        message_id = message['message_id']
+        genres = [callback for callback in callbacks(data) if callback.startswith('g:')]
+
+        confirm = api.expect(lambda method, data: method == 'editMessageText'
+                             and int(data['message_id']) == message_id and 'confirm_forward' in callbacks(data))
+        await self.step('genre -> confirm prompt', confirm,
+                        lambda: self.click(user_id, message_id, genres[session % len(genres)]))
+
+        done = api.expect(lambda method, data: method == 'editMessageText'
+                          and int(data['message_id']) == message_id and not callbacks(data))
+        await self.step('confirm -> thank you', done, lambda: self.click(user_id, message_id, 'confirm_forward'))
+
+    async def user_sessions(self, user_id):
+        for session in range(self.args.uploads):
+            await self.upload_session(user_id, session)
+
+    def deliveries(self, text) -> Counter:
+        return Counter(int(data['chat_id']) for _, method, data in self.api.calls
+                       if method == 'sendMessage' and data.get('text') == text)
+
+    async def delivered_to(self, text, count):
+        while sum(self.deliveries(text).values()) < count:
+            await asyncio.sleep(0.02)
+
+    async def settled(self, text) -> int:
+        # Sends already handed to the API scheduler still go out after a pause or cancel, behind any
+        # interactive replies and flood waits; returns the count once none came for a second
+        count = sum(self.deliveries(text).values())
+        while True:
+            await asyncio.sleep(1 + self.args.retry_after * (self.args.rate_429 > 0))
+            latest = sum(self.deliveries(text).values())
+            if latest == count:
+                return count
+            count = latest
+
+    async def admin_command(self, command, reply):
+        admin = self.bot.ADMIN_USER_ID
+        answer = self.api.expect(lambda method, data: method == 'sendMessage' and int(data['chat_id']) == admin
+                                 and reply in data.get('text', ''))
+        await self.step(command, answer, lambda: self.send_text(admin, command))
+
+    async def broadcast(self, number, cancel=False):
+        admin = self.bot.ADMIN_USER_ID
+        text = f'Benchmark broadcast {number}'
+        recipients = set(self.bot.ALLOWED_USERS)
+        total = len(recipients)
+
+        def delivered_to_all(method, data):
+            if method == 'sendMessage' and data.get('text') == text:
+                recipients.discard(int(data['chat_id']))
+            return not recipients
+
+        prompt = self.api.expect(lambda method, data: method == 'sendMessage' and int(data['chat_id']) == admin)
+        await self.step('broadcast command', prompt, lambda: self.send_text(admin, '/broadcast'))
+        if cancel:
+            await self.cancel(text, total)
+            return
+        delivered = self.api.expect(delivered_to_all)
+        running = asyncio.ensure_future(self.step('broadcast delivered to all', delivered,
+                                                  lambda: self.send_text(admin, text)))
+        tasks = [running]
+        if self.args.control:
+            tasks.append(self.pause_resume_restart(text, total))
+        tasks += [self.probe(user_id, text, running) for user_id in sorted(recipients - {admin})[:self.args.probes]]
+        await asyncio.gather(*tasks)
+        counts = self.deliveries(text)
+        self.control['duplicates'].append(sum(count - 1 for count in counts.values()))
+
+    async def pause_resume_restart(self, text, total):
+        # Nothing may go out while paused, and every recipient gets the message exactly once across a
+        # pause, a resume and a restart of the bot in the middle of sending
+        await self.delivered_to(text, total // 3)
+        await self.admin_command('/pause_broadcast', 'paused')
+        settled = await self.settled(text)
+        await asyncio.sleep(1)
+        self.control['sent while paused'].append(sum(self.deliveries(text).values()) - settled)
+        await self.admin_command('/resume_broadcast', 'resumed')
+
+        await self.delivered_to(text, total * 2 // 3)
+        started = time.perf_counter()
+        starts = sum(1 for _, method, _ in self.api.calls if method == 'deleteWebhook')
+        self.restarting = True
+        self.restart.set()
+        os.kill(os.getpid(), signal.SIGINT)
+        while sum(1 for _, method, _ in self.api.calls if method == 'deleteWebhook') == starts:
+            await asyncio.sleep(0.05)
+        self.restarting = False
+        self.control['restart seconds'].append(time.perf_counter() - started)
+
+    async def cancel(self, text, total):
+        admin = self.bot.ADMIN_USER_ID
+        summary = self.api.expect(lambda method, data: method in ('sendMessage', 'editMessageText')
+                                  and int(data['chat_id']) == admin and 'not sent' in data.get('text', ''))
+        self.send_text(admin, text)
+        await self.delivered_to(text, total // 3)
+        await self.admin_command('/cancel_broadcast', 'cancelled')
+        await asyncio.wait_for(summary, self.args.timeout)
+        settled = await self.settled(text)
+        await asyncio.sleep(1)
+        self.control['sent after cancel'].append(sum(self.deliveries(text).values()) - settled)
+        self.control['not sent after cancel'].append(total - settled)
+
+    async def probe(self, user_id, text, running):
+        # Interactive replies go ahead of queued broadcast sends, so /start should stay fast.
+        # Not measured while the bot is down for the restart.
+        while not running.done():
+            if self.restarting:
+                await asyncio.sleep(0.05)
+                continue
+            reply = self.api.expect(lambda method, data: method == 'sendMessage' and int(data['chat_id']) == user_id
+                                    and data.get('text') != text)
+            await self.step('/start during broadcast', reply, lambda: self.send_text(user_id, '/start'))
+            await asyncio.sleep(0.2)
+
+    async def forwards_drained(self, expected):
+        deadline = time.monotonic() + self.args.timeout
+        while time.monotonic() < deadline:
+            if sum(1 for _, method, _ in self.api.calls if method in ('copyMessage', 'sendMediaGroup')) >= expected:
+                return True
+            await asyncio.sleep(0.05)
+        return False
+
+async def scenario(generator, report):
+    api, bot, args = generator.api, generator.bot, generator.args
+    # Wait for the bot's first getUpdates, i.e. for main() to be up
+    while not any(method == 'deleteWebhook' for _, method, _ in api.calls):
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.2)
+
+    user_ids = range(FIRST_USER_ID, FIRST_USER_ID + args.users)
+    started = time.perf_counter()
+    first_call = len(api.calls)
+    await asyncio.gather(*[generator.user_sessions(user_id) for user_id in user_ids])
+    uploads_done = time.perf_counter()
+    uploads = args.users * args.uploads
+    report['drained'] = await generator.forwards_drained(uploads * math.ceil(args.tracks / bot.MEDIA_GROUP_SIZE))
+    report['upload_seconds'] = uploads_done - started
+    report['drain_seconds'] = time.perf_counter() - started
+    report['upload_updates'] = generator.updates_sent
+    report['upload_calls'] = Counter(method for _, method, _ in api.calls[first_call:]
+                                     if method not in LIFECYCLE_METHODS)
+    report['uploads'] = uploads
+
+    broadcast_started = time.perf_counter()
+    for number in range(args.broadcasts):
+        await generator.broadcast(number)
+    report['broadcast_seconds'] = time.perf_counter() - broadcast_started
+    report['control'] = generator.control
+    if args.control:
+        await generator.broadcast(args.broadcasts, cancel=True)
+    report['steps'] = generator.step_latency
+
+def run_api_thread(api, ready):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    api.loop = loop
+    loop.run_until_complete(api.start())
+    ready.set()
+    loop.run_forever()
+
+def print_report(bot, api, args, report):
+    print(f"\n{args.users} users x {args.uploads} uploads x {args.tracks} tracks, {args.broadcasts} broadcast(s), "
+          f"API latency {args.latency * 1000:.0f} ms, {api.injected_429} injected 429s")
+    if 'upload_seconds' not in report:
+        print("The run did not complete, no results")
+        return
+    uploads = report['uploads']
+    if uploads:
+        print(f"Updates/s:              {report['upload_updates'] / report['upload_seconds']:.1f} "
+              f"({report['upload_updates']} updates in {report['upload_seconds']:.2f}s)")
+        print(f"Uploads/s:              {uploads / report['upload_seconds']:.1f}, forwards "
+              f"{'drained' if report['drained'] else 'NOT drained'} after {report['drain_seconds']:.2f}s")
+        calls = report['upload_calls']
+        print(f"API calls per upload:   {sum(calls.values()) / uploads:.2f} "
+              f"({', '.join(f'{method} {count / uploads:.2f}' for method, count in calls.most_common())})")
+    if args.broadcasts and 'broadcast_seconds' in report:
+        sent = args.broadcasts * args.users
+        print(f"Broadcast messages/s:   {sent / report['broadcast_seconds']:.1f}"
+              f"{' (including the pauses and restarts)' if args.control else ''}")
+        print(f"Duplicate deliveries:   {sum(report['control']['duplicates'])}")
+    for name, values in report.get('control', {}).items():
+        if name != 'duplicates':
+            print(f"{name[0].upper() + name[1:] + ':':23} {', '.join(f'{value:g}' for value in values)}")
+
+    print("\nEnd-to-end step latency (p50 / p99 / max ms):")
+    for name, values in report.get('steps', {}).items():
+        print(f"  {name:28} {percentile(values, 0.5) * 1000:8.1f} {percentile(values, 0.99) * 1000:8.1f} "
+              f"{max(values) * 1000:8.1f}  (n={len(values)})")
+    print("\nHandler latency from the bot's own metrics (p50 / p99 ms):")
+    for name, histogram in sorted(bot.METRICS.handler_latency.items()) + sorted(bot.METRICS.step_latency.items()):
+        print(f"  {name:28} {histogram.quantile(0.5) * 1000:8.1f} {histogram.quantile(0.99) * 1000:8.1f}"
+              f"  (n={histogram.count})")
+    errors = sum(bot.METRICS.handler_errors.values())
+    retries = sum(bot.METRICS.api_retry_after.values())
+    print(f"\nHandler errors: {errors}, flood waits seen by the scheduler: {retries}")
+
+def main():
+    args = parse_args()
+    api = FakeBotAPI(latency=args.latency, rate_429=args.rate_429, retry_after=args.retry_after)
+    ready = threading.Event()
+    threading.Thread(target=run_api_thread, args=(api, ready), daemon=True).start()
+    ready.wait()
+    bot = load_bot(api, args)
+
+    report = {}
+    generator = LoadGenerator(api, bot, args)
+
+    def drive():
+        # The fake API's loop runs the load; the bot's run_polling() owns the main thread
+        try:
+            asyncio.run_coroutine_threadsafe(scenario(generator, report), api.loop).result()
+        except Exception:
+            traceback.print_exc()
+        os.kill(os.getpid(), signal.SIGINT)
+
+    threading.Thread(target=drive, daemon=True).start()
+    bot.main()
+    while generator.restart.is_set():
+        generator.restart.clear()
+        # run_polling() closes the event loop it ran on
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        bot.main()
+    print_report(bot, api, args, report)
+
+if __name__ == '__main__':
+    main()